@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# A persistent cache of compressed PSISO blocks.
+#
+# Blocks are keyed by the SHA1 of the uncompressed 0x9300 byte block
+# together with the compression level and the deflate backend that was used,
+# so rebuilding an EBOOT.PBP for a disc we have already encoded only costs
+# the I/O and not the CPU time to recompress it.
+#
+# The cache is a single sqlite3 database in WAL mode and every thread that
+# uses it gets its own connection, so the compression workers can look up
+# blocks at the same time. Once it grows above max_size the least recently
+# used blocks are evicted as new blocks are added.
+#
+import os
+import sqlite3
+import threading
+import time
+
+
+class blockcache(object):
+    def __init__(self, path, max_size=2048 * 1024 * 1024):
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._conns = []
+        self._hits = 0
+        self._misses = 0
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS blocks ('
+                   'digest BLOB, level INTEGER, backend TEXT, '
+                   'data BLOB, size INTEGER, atime INTEGER, '
+                   'PRIMARY KEY (digest, level, backend))')
+        db.execute('CREATE INDEX IF NOT EXISTS blocks_atime '
+                   'ON blocks (atime)')
+        self._size = db.execute('SELECT SUM(size) FROM blocks').fetchone()[0] or 0
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # autocommit, WAL only syncs at checkpoints with synchronous=NORMAL
+            db = sqlite3.connect(self._path, timeout=60, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            with self._lock:
+                self._conns.append(db)
+        return db
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    # None if it is not cached, b'' means the block is stored as is
+    def get(self, digest, level, backend):
+        db = self._db()
+        r = db.execute('SELECT data FROM blocks WHERE digest = ? '
+                       'AND level = ? AND backend = ?',
+                       (digest, level, backend)).fetchone()
+        with self._lock:
+            if r is None:
+                self._misses = self._misses + 1
+                return None
+            self._hits = self._hits + 1
+        db.execute('UPDATE blocks SET atime = ? WHERE digest = ? '
+                   'AND level = ? AND backend = ?',
+                   (time.time_ns(), digest, level, backend))
+        return r[0]
+
+    def put(self, digest, level, backend, data):
+        self._db().execute('INSERT OR REPLACE INTO blocks VALUES '
+                           '(?, ?, ?, ?, ?, ?)',
+                           (digest, level, backend, bytes(data), len(data),
+                            time.time_ns()))
+        with self._lock:
+            self._size = self._size + len(data)
+            full = self._size > self._max_size
+        if full:
+            # make some room so we do not have to evict on every insert
+            self.evict(int(self._max_size * 0.9))
+
+    def evict(self, target=None):
+        if target is None:
+            target = self._max_size
+        db = self._db()
+        size = db.execute('SELECT SUM(size) FROM blocks').fetchone()[0] or 0
+        if size > target:
+            victims = []
+            for r in db.execute('SELECT rowid, size FROM blocks '
+                                'ORDER BY atime'):
+                if size <= target:
+                    break
+                victims.append((r[0],))
+                size = size - r[1]
+            db.executemany('DELETE FROM blocks WHERE rowid = ?', victims)
+        with self._lock:
+            self._size = size
+
+    def flush(self):
+        self._db().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            for db in self._conns:
+                db.close()
+            self._conns = []
+        self._local = threading.local()
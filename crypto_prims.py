@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# AES and XOR helpers shared by make_isoedat, document and vmp.
+#
+# The AES work is always done in as few calls into pycryptodome as possible
+# so that the per call overhead of python does not dominate:
+#  - AES-CMAC is a single CBC pass over the whole message followed by one
+#    ECB encryption of the last block.
+#  - XOR is done on python ints instead of byte by byte.
+#  - ECB cipher objects and the CMAC subkeys are cached for the fixed keys.
+#    Callers with a new key for every message, like the EDAT block keys,
+#    pass a cipher from new_ecb() to aes_cmac() instead so they do not push
+#    the fixed keys out of the cache.
+#
+# Run this file to benchmark the helpers against byte at a time versions.
+#
+import argparse
+import functools
+import random
+import time
+try:
+    from Crypto.Cipher import AES
+except:
+    print('Crypto is not installed.\nYou should install Crypto by running:\npip3 install pycryptodome')
+
+
+# only the first len(x) bytes of y are used
+def xor(x, y):
+    n = len(x)
+    return (int.from_bytes(x, 'big') ^ int.from_bytes(y[:n], 'big')).to_bytes(n, 'big')
+
+
+def xor_byte(x, c):
+    return xor(x, bytes([c]) * len(x))
+
+
+def new_ecb(key):
+    return AES.new(bytes(key), AES.MODE_ECB)
+
+
+# ECB has no state so one cached cipher per key can be shared by all threads
+@functools.lru_cache(maxsize=64)
+def ecb(key):
+    return new_ecb(key)
+
+
+def cbc_encrypt(key, data, iv=bytes(16)):
+    return AES.new(bytes(key), AES.MODE_CBC, IV=bytes(iv)).encrypt(bytes(data))
+
+
+# last block of the CBC encryption, data must be a multiple of 16 bytes
+def cbc_mac(key, data, iv=bytes(16)):
+    if not len(data):
+        return bytes(iv)
+    return cbc_encrypt(key, data, iv)[-16:]
+
+
+def _shift(block):
+    return ((int.from_bytes(block, 'big') << 1) & ((1 << 128) - 1)).to_bytes(16, 'big')
+
+
+def _subkeys(cipher):
+    L = cipher.encrypt(bytes(16))
+    K1 = _shift(L)
+    if L[0] & 0x80:
+        K1 = xor(K1, bytes(15) + b'\x87')
+    K2 = _shift(K1)
+    if K1[0] & 0x80:
+        K2 = xor(K2, bytes(15) + b'\x87')
+    return K1, K2
+
+
+@functools.lru_cache(maxsize=64)
+def cmac_subkeys(key):
+    return _subkeys(ecb(key))
+
+
+# the last block of M, padded and XORed with the right subkey, and the
+# length of the rest of M
+def cmac_last_block(K1, K2, M):
+    n = int((len(M) + 15) / 16)
+    if n and (len(M) % 16) == 0:
+        return xor(M[(n - 1) * 16:], K1), (n - 1) * 16
+    n = max(n, 1)
+    return xor((bytes(M[(n - 1) * 16:]) + b'\x80' + bytes(15))[:16], K2), (n - 1) * 16
+
+
+# RFC 4493. Pass a cipher from new_ecb() if K is not one of the fixed keys.
+def aes_cmac(K, M, cipher=None):
+    K = bytes(K)
+    if cipher is None:
+        cipher = ecb(K)
+        K1, K2 = cmac_subkeys(K)
+    else:
+        K1, K2 = _subkeys(cipher)
+    M_last, n = cmac_last_block(K1, K2, M)
+    X = cbc_mac(K, bytes(M[:n]))
+    return cipher.encrypt(xor(M_last, X))
+
+
+# only used to check and benchmark aes_cmac()
+def _aes_cmac_bytewise(K, M):
+    def _xor(x, y):
+        out = bytearray(x)
+        for i in range(len(out)):
+            out[i] ^= y[i]
+        return out
+
+    def ls(data):
+        out = bytearray(len(data))
+        for i in range(len(data)):
+            out[i] = (data[i] << 1) & 0xff
+            if i > 0 and data[i] & 0x80:
+                out[i - 1] |= 0x01
+        return out
+
+    L = AES.new(K, AES.MODE_ECB).encrypt(bytes(16))
+    K1 = ls(L)
+    if L[0] & 0x80:
+        K1[15] ^= 0x87
+    K2 = ls(K1)
+    if K1[0] & 0x80:
+        K2[15] ^= 0x87
+    n = int((len(M) + 15) / 16)
+    if n and (len(M) % 16) == 0:
+        M_last = _xor(M[(n - 1) * 16:n * 16], K1)
+    else:
+        n = max(n, 1)
+        M_last = _xor((bytes(M[(n - 1) * 16:]) + b'\x80' + bytes(15))[:16], K2)
+    X = bytearray(16)
+    for i in range(1, n):
+        X = AES.new(K, AES.MODE_ECB).encrypt(bytes(_xor(X, M[(i - 1) * 16:i * 16])))
+    return AES.new(K, AES.MODE_ECB).encrypt(bytes(_xor(M_last, X)))
+
+
+def _xor_bytewise(x, y):
+    out = bytearray(x)
+    for i in range(len(out)):
+        out[i] ^= y[i]
+    return bytes(out)
+
+
+def benchmark(size=0x4000, rounds=20):
+    r = random.Random(0)
+    key = r.randbytes(16)
+    msgs = [r.randbytes(size), r.randbytes(size - 5)]
+    for m in msgs + [b'', r.randbytes(16), r.randbytes(17)]:
+        if aes_cmac(key, m) != _aes_cmac_bytewise(key, m) or \
+           aes_cmac(key, m, new_ecb(key)) != _aes_cmac_bytewise(key, m):
+            raise Exception('aes_cmac() does not match the reference')
+
+    res = []
+    for name, func in (('aes_cmac', lambda m: aes_cmac(key, m)),
+                       ('aes_cmac bytewise', lambda m: _aes_cmac_bytewise(key, m)),
+                       ('xor', lambda m: xor(m, msgs[0])),
+                       ('xor bytewise', lambda m: _xor_bytewise(m, msgs[0]))):
+        t = time.perf_counter()
+        for i in range(rounds):
+            for m in msgs:
+                func(m)
+        t = time.perf_counter() - t
+        res.append((name, rounds * sum(len(m) for m in msgs) / (t if t else 1e-9) / 1000000))
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=0x4000,
+                        help='Size of the messages to benchmark. Default is 16384.')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='Number of rounds. Default is 20.')
+    args = parser.parse_args()
+
+    for name, s in benchmark(args.size, args.rounds):
+        print('%-20s %10.1f MB/s' % (name, s))
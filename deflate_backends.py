@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Deflate implementations that can be used to compress the PSISO blocks in
+# an EBOOT.PBP.
+#
+# P.O.P.S inflates every block as a raw deflate stream so any implementation
+# that can produce raw deflate can be used. The stdlib zlib is always
+# available but zlib-ng, ISA-L and libdeflate are used if their python
+# bindings are installed:
+#    pip3 install zlib-ng isal deflate
+#
+# The default backend is stdlib zlib so that the same image always gives
+# the same EBOOT.PBP. The other backends have to be asked for by name, or
+# as 'fastest' which runs a micro-benchmark that compresses a sample buffer
+# with every available backend and picks the fastest one that does not make
+# the output noticeably bigger than stdlib zlib does.
+#
+import argparse
+import random
+import time
+import zlib
+
+
+class zlib_backend(object):
+    name = 'zlib'
+    levels = range(1, 10)
+
+    def __init__(self):
+        self._zlib = zlib
+
+    def compress(self, buf, level):
+        z = self._zlib.compressobj(level, self._zlib.DEFLATED, -15)
+        return z.compress(buf) + z.flush()
+
+
+class zlib_ng_backend(zlib_backend):
+    name = 'zlib-ng'
+
+    def __init__(self):
+        from zlib_ng import zlib_ng
+        self._zlib = zlib_ng
+
+
+class isal_backend(zlib_backend):
+    name = 'isal'
+    # ISA-L only has levels 0-3 and level 0 is not uncompressed
+    levels = range(1, 4)
+
+    def __init__(self):
+        from isal import isal_zlib
+        self._zlib = isal_zlib
+
+
+class libdeflate_backend(object):
+    name = 'libdeflate'
+    levels = range(1, 10)
+
+    def __init__(self):
+        import deflate
+        self._deflate = deflate
+
+    def compress(self, buf, level):
+        return self._deflate.deflate_compress(bytes(buf), level)
+
+
+# Tries several deflate settings for every block and keeps the smallest.
+# Level 1 is one of them so we never do worse than the default.
+class archive_backend(object):
+    name = 'archive'
+    levels = range(1, 10)
+
+    def __init__(self):
+        # (level, wbits, memLevel, strategy)
+        self._candidates = []
+        for level in (1, 6, 9):
+            for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+                for memlevel in (8, 9):
+                    self._candidates.append((level, -15, memlevel, strategy))
+        self._candidates.append((9, -15, 9, zlib.Z_RLE))
+        self._candidates.append((9, -12, 9, zlib.Z_DEFAULT_STRATEGY))
+        # libdeflate level 12 usually beats everything zlib can do
+        self._libdeflate = None
+        for b in available_backends():
+            if b.name == 'libdeflate':
+                self._libdeflate = b
+
+    def compress(self, buf, level):
+        return self.compress_archive(buf)[0]
+
+    # Returns the smallest result and the length of the level 1 candidate
+    def compress_archive(self, buf):
+        best = None
+        default_len = None
+        for l, w, m, s in self._candidates:
+            z = zlib.compressobj(l, zlib.DEFLATED, w, m, s)
+            c = z.compress(buf) + z.flush()
+            if default_len is None:
+                default_len = len(c)
+            if best is None or len(c) < len(best):
+                best = c
+        if self._libdeflate:
+            c = self._libdeflate.compress(buf, 12)
+            if len(c) < len(best):
+                best = c
+        return best, default_len
+
+
+_backends = [zlib_backend, zlib_ng_backend, isal_backend, libdeflate_backend]
+_available = None
+_selected = {}
+
+
+def available_backends():
+    global _available
+    if _available is None:
+        _available = []
+        for b in _backends:
+            try:
+                _available.append(b())
+            except ImportError:
+                True
+    return _available
+
+
+# name can also be 'fastest'
+def get_backend(name, level=None):
+    if name == 'fastest':
+        return select_backend(level or 1)
+    for b in available_backends():
+        if b.name == name:
+            if level and level not in b.levels:
+                raise Exception('Deflate backend %s does not support level %d' % (name, level))
+            return b
+    raise Exception('Deflate backend %s is not available' % name)
+
+
+# zero filled, repetitive and incompressible blocks, a bit like a PSX disc
+def benchmark_sample():
+    r = random.Random(0)
+    sample = bytearray()
+    sample += bytes(0x9300)
+    sample += bytes(r.getrandbits(3) for i in range(0x9300))
+    sample += (b'PlayStation SLUS_000.00 ' * 0x9300)[:0x9300]
+    sample += bytes(r.getrandbits(8) for i in range(0x9300))
+    return bytes(sample)
+
+
+# Returns a list of (backend, MB/s, compressed size). Backends that do not
+# inflate back to the sample are skipped.
+def benchmark(level, sample=None, rounds=5):
+    if not sample:
+        sample = benchmark_sample()
+    blocks = [sample[i:i + 0x9300] for i in range(0, len(sample), 0x9300)]
+    res = []
+    for b in available_backends():
+        if level not in b.levels:
+            continue
+        try:
+            size = 0
+            for blk in blocks:
+                c = b.compress(blk, level)
+                if zlib.decompress(c, wbits=-15) != blk:
+                    raise Exception('Bad deflate stream')
+                size = size + len(c)
+        except Exception as e:
+            print('Deflate backend', b.name, 'failed:', e)
+            continue
+        t = time.perf_counter()
+        for i in range(rounds):
+            for blk in blocks:
+                b.compress(blk, level)
+        t = time.perf_counter() - t
+        res.append((b, rounds * len(sample) / (t if t else 1e-9) / 1000000, size))
+    return res
+
+
+# The fastest backend whose output is at most tolerance times bigger than
+# stdlib zlib
+def select_backend(level, sample=None, tolerance=1.05):
+    if level in _selected:
+        return _selected[level]
+    best = zlib_backend()
+    if len(available_backends()) > 1 and level in best.levels:
+        res = benchmark(level, sample=sample)
+        zsize = [r[2] for r in res if r[0].name == 'zlib'][0]
+        speed = 0
+        for b, s, size in res:
+            if size <= zsize * tolerance and s > speed:
+                best = b
+                speed = s
+    _selected[level] = best
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--level', type=int, default=1,
+                        help='Compression level to benchmark. Default is 1.')
+    args = parser.parse_args()
+
+    for b, s, size in benchmark(args.level):
+        print('%-12s %8.1f MB/s %8d bytes' % (b.name, s, size))
+    print('Selected:', select_backend(args.level).name)
@@ -22,10 +22,12 @@ import sys
 import zipfile
 
 from dataclasses import dataclass
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict
 
 from pathlib import Path
 
+from crypto_prims import cbc_mac, cmac_subkeys, ecb, xor
+
 verbose = False
 
 des_key = bytes([0x39, 0xF7, 0xEF, 0xA1, 0x6C, 0xCE, 0x5F, 0x4C])
@@ -79,15 +81,12 @@ def BBMacInit(mkey: MACKey) -> int:
     mkey.key[:] = b'\x00' * 0x10
     mkey.pad[:] = b'\x00' * 0x10
 
-def _sub_158_encrypt_block(block: bytes, key: bytearray, key_type: int) -> Tuple[bytes, bytes]:
+def _sub_158_encrypt_block(block: bytes, key: bytearray, key_type: int) -> bytes:
+    # XORing the first block with key and encrypting with a zero IV is
+    # the same as CBC with key as the IV, so we only need the last block.
     if len(block) % 0x10 != 0:
         _raise('Encrypt block size must be multiple of 16')
-    b = bytearray(block)
-    for i in range(0x10):
-        b[i] ^= key[i]
-    ct = _encrypt_iv0(bytes(b), key_type)
-    key_next = ct[-0x10:] if len(ct) >= 0x10 else (b'\x00' * 0x10)
-    return ct, key_next
+    return cbc_mac(KEY_VAULT[key_type], block, key)
 
 def BBMacUpdate(mkey: MACKey, buf: bytes):
     if mkey.pad_size > 16:
@@ -106,51 +105,26 @@ def BBMacUpdate(mkey: MACKey, buf: bytes):
     tail = stream[full_len:]
     mkey.pad[:rem] = tail
     mkey.pad_size = rem
-    p = 0
-    while p < full_len:
-        chunk = stream[p:p + min(0x0800, full_len - p)]
-        ct, key_next = _sub_158_encrypt_block(chunk, mkey.key, 0x38)
-        mkey.key[:] = key_next
-        p += len(chunk)
-
-def left_shift_1(block16: bytes) -> bytes:
-    b = bytearray(16)
-    carry = 0
-    for i in reversed(range(16)):
-        v = block16[i]
-        b[i] = ((v << 1) & 0xFF) | carry
-        carry = 1 if (v & 0x80) else 0
-    if carry:
-        b[15] ^= 0x87
-    return bytes(b)
+    # the whole stream in one CBC pass instead of 0x800 bytes at a time
+    mkey.key[:] = _sub_158_encrypt_block(stream[:full_len], mkey.key, 0x38)
 
 def BBMacFinal(mkey: MACKey, out16: bytearray, vkey: Optional[bytes]) -> int:
     if mkey.pad_size > 16:
         _raise('MAC Key padding size must be do not exceed 16 bytes')
-    L = _encrypt_iv0(b'\x00' * 16, 0x38)
-    K1 = left_shift_1(L)
-    K2 = left_shift_1(K1)
+    K1, K2 = cmac_subkeys(KEY_VAULT[0x38])
     pad = bytearray(mkey.pad)
     if mkey.pad_size < 16:
         pad[mkey.pad_size] = 0x80
-        for j in range(mkey.pad_size + 1, 16):
-            pad[j] = 0x00
+        pad[mkey.pad_size + 1:] = bytes(15 - mkey.pad_size)
         subkey = K2
     else:
         subkey = K1
-    for i in range(16):
-        pad[i] ^= subkey[i]
-    final_block = bytes(pad)
-    ct, key_next = _sub_158_encrypt_block(final_block, mkey.key, 0x38)
-    tmp1 = bytearray(ct[-16:])
-    for i in range(16):
-        tmp1[i] ^= KEY_VAULT[0x03][i]
+    final_block = xor(pad, subkey)
+    tmp1 = xor(_sub_158_encrypt_block(final_block, mkey.key, 0x38), KEY_VAULT[0x03])
     if vkey is not None:
         if len(vkey) != 16:
             _raise('Version Key must be 16 bytes')
-        for i in range(16):
-            tmp1[i] ^= vkey[i]
-        tmp1 = bytearray(_encrypt_iv0(bytes(tmp1), 0x38))
+        tmp1 = ecb(KEY_VAULT[0x38]).encrypt(xor(tmp1, vkey))
     out16[:16] = tmp1[:16]
     mkey.key[:] = b'\x00' * 16
     mkey.pad[:] = b'\x00' * 16
@@ -165,8 +139,7 @@ def bbmac_getkey(mkey: MACKey, bbmac: bytes) -> int:
     mac_working = bytearray(bbmac)
     mac_working[:] = _decrypt_iv0(bytes(mac_working), 0x63)
     decrypted = _decrypt_iv0(bytes(mac_working), 0x38)
-    for i in range(16):
-        vkey_out[i] = tmp[i] ^ decrypted[i]
+    vkey_out[:] = xor(tmp, decrypted)
     return vkey_out
 
 def pops_get_secure_install_id(buf: bytes) -> bytes:
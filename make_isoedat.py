@@ -6,13 +6,15 @@
 # but only the parts that are used when creating a PSX classics
 # ISO.BIN.EDAT for PS3 packages
 #
+import collections
 import hashlib
+import io
 import os
 import struct
-try:
-    from Crypto.Cipher import AES
-except:
-    print('Crypto is not installed.\nYou should install Crypto by running:\npip3 install Crypto')
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from crypto_prims import aes_cmac, cbc_encrypt, ecb, new_ecb, xor
 
 NPDRM_PSX_KEY = bytes([
     0x52, 0xC0, 0xB5, 0xCA,  0x76, 0xD6, 0x13, 0x4B,
@@ -31,71 +33,69 @@ EDAT_FOOTER_V1 = bytes([
     0x63, 0x6B, 0x61, 0x67,  0x65, 0x72, 0x00, 0x00
 ])
 
-def xor(x, y):
-    out = bytearray(x)
-    for i in range(len(out)):
-        out[i] ^= y[i]
-    return out
-
-def aes_cmac(K, M):
-    def generate_subkeys(KEY):
-        def ls(data):
-            out = bytearray(len(data))
-            for i in range(len(data)):
-                out[i] = (data[i] << 1) & 0xff
-                if i > 0 and data[i] & 0x80:
-                    out[i - 1] |= 0x01
-            return out
-
-        obj = AES.new(KEY, AES.MODE_ECB)
-        L = obj.encrypt(bytes(16))
-        K1 = ls(L)
-        if L[0] & 0x80:
-            K1[15] ^= 0x87
-        K2 = ls(K1)
-        if K1[0] & 0x80:
-            K2[15] ^= 0x87
-        return (K1, K2)
-
-    K1, K2 = generate_subkeys(K)
-    n = int((len(M) + 15) / 16)
-    if n == 0:
-        n = 1
-        flag = False
-    else:
-        if (len(M) % 16) == 0:
-            flag = True
-        else:
-            flag = False
+def _pwrite(fd, buf, offset, lock):
+    buf = memoryview(buf)
+    if hasattr(os, 'pwrite'):
+        while len(buf):
+            n = os.pwrite(fd, buf, offset)
+            buf = buf[n:]
+            offset = offset + n
+        return
+    # no pwrite() on windows
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while len(buf):
+            buf = buf[os.write(fd, buf):]
+
+
+def encrypt_blocks(npd, first, data):
+    """
+    Encrypt and MAC the 0x4000 byte blocks in data, starting with block
+    number first. This is called from the worker threads.
+    Returns the encrypted blocks and their metadata, the MAC of every block.
+    """
+    n = int((len(data) + 0x3fff) / 0x4000)
+    # the block keys of all blocks in one go
+    b_keys = bytearray(16 * n)
+    for j in range(n):
+        if npd['version'] > 1:
+            b_keys[j * 16:j * 16 + 16] = npd['dev_hash']
+        struct.pack_into('>I', b_keys, j * 16 + 12, first + j)
+    key_results = ecb(NPDRM_PSX_KEY).encrypt(bytes(b_keys))
+
+    enc = []
+    metadata = bytearray()
+    for j in range(n):
+        key_result = key_results[j * 16:j * 16 + 16]
+        dec_data = data[j * 0x4000:(j + 1) * 0x4000]
+        orig_len = (len(dec_data) + 0x0f) & 0xfffff0
+        if len(dec_data) % 0x4000:
+            dec_data = (bytes(dec_data) + bytes(0x4000))[:0x4000]
 
-    if flag:
-        M_last = xor(M[(n - 1) * 16:n * 16], K1)
+        enc_data = cbc_encrypt(key_result, dec_data)[:orig_len]
+        enc.append(enc_data)
+        # hash_result
+        # key_result is the key to generate hash_result
+        metadata += aes_cmac(key_result, enc_data, new_ecb(key_result))
+    return b''.join(enc), metadata
+
+
+def pack(ifn, ofn, cid, threads=None, batch=64):
+    """
+    Encrypt ifn into the EDAT file ofn. ifn is either a file name or
+    the contents of the file as a bytes-like object.
+    The blocks are encrypted and MACed batch blocks at a time in a pool of
+    threads workers, the default is one per CPU, and every batch is written
+    straight to its place in the file. The metadata section is kept in
+    memory and the header is written last, once all the hashes are known.
+    """
+    if not threads:
+        threads = os.cpu_count() or 1
+
+    if isinstance(ifn, (bytes, bytearray, memoryview)):
+        i = io.BytesIO(ifn)
     else:
-        _m = M[(n - 1) * 16:] + bytes([0x80, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-                                       0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-        _m = _m[:16]
-        M_last = xor( _m[:16], K2)
-    X = bytearray(16)
-    for i in range(1, n):
-        Y = xor(X, M[(i - 1) * 16:i * 16])
-        obj = AES.new(K, AES.MODE_ECB)
-        X = obj.encrypt(bytes(Y))
-    Y = xor(M_last, X)
-    obj = AES.new(K, AES.MODE_ECB)
-    T = obj.encrypt(bytes(Y))
-    return T
-
-        
-def pack(ifn, ofn, cid):
-    def get_block_key(npd, i):
-        b = bytearray(16)
-        if npd['version'] > 1:
-            b = npd['dev_hash']
-        struct.pack_into('>I', b, 12, i)
-        return b
-    
-    i = open(ifn, 'rb')
-    o = open(ofn, 'wb', buffering=0)
+        i = open(ifn, 'rb')
     
     i.seek(0, 2)
     fs = i.tell()
@@ -113,17 +113,6 @@ def pack(ifn, ofn, cid):
     b = bytearray(0x30)
     b[:len(npd['content_id'])] = npd['content_id'].encode()
     b = b + ofn.split('/')[-1].encode()
-    
-    _key = bytes([0x2b, 0x7e, 0x15, 0x16,  0x28, 0xae, 0xd2, 0xa6,
-                 0xab, 0xf7, 0x15, 0x88,  0x09, 0xcf, 0x4f, 0x3c,])
-    _b = bytes([0x6b, 0xc1, 0xbe, 0xe2,  0x2e, 0x40, 0x9f, 0x96,
-               0xe9, 0x3d, 0x7e, 0x11,  0x73, 0x93, 0x17, 0x2a,
-               0xae, 0x2d, 0x8a, 0x57,  0x1e, 0x03, 0xac, 0x9c,
-               0x9e, 0xb7, 0x6f, 0xac,  0x45, 0xaf, 0x8e, 0x51,
-               0x30, 0xc8, 0x1c, 0x46,  0xa3, 0x5c, 0xe4, 0x11
-               ])
-    _b = bytes([0x6b, 0xc1, 0xbe, 0xe2,  0x2e, 0x40, 0x9f, 0x96,
-               0xe9, 0x3d, 0x7e, 0x11,  0x73, 0x93, 0x17, 0x2a])
 
     key = NPDRM_OMAC_KEY_3
     npd['title_hash'] = aes_cmac(key, b)
@@ -145,72 +134,48 @@ def pack(ifn, ofn, cid):
     npd['unk2'] = 0
     npd_buf = npd_buf + npd['dev_hash'] + bytes(0x10)
 
-    o.write(npd_buf)
     b = bytearray(16)
     struct.pack_into('>I', b, 0, 0)
     struct.pack_into('>I', b, 4, 0x4000)
     struct.pack_into('>Q', b, 8, fs)
-    o.write(b)
+    # the header, the metadata hash, the header hash and the two random
+    # numbers that we leave as zero
+    header = bytearray(npd_buf + b + bytes(0x70))
 
     # encrypt data
     block_num = (fs + 0x4000 - 1) >> 14
-    for idx in range(block_num):
-        length = 0x4000
-        if idx == (block_num - 1) and (fs & 0x3fff):
-            length = fs & 0x3fff
-        length = (length + 0x0f) & 0xfffff0
-
-        b_key = get_block_key(npd, idx)
-        
-        obj = AES.new(NPDRM_PSX_KEY, AES.MODE_ECB)
-        key_result = obj.encrypt(bytes(b_key))
-        hash = key_result
-
-        i.seek(idx * 0x4000)
-        dec_data = bytes(i.read(length))
-        orig_len = (len(dec_data) + 0x0f) & 0xfffff0
-        if len(dec_data) % 0x4000:
-            dec_data = (dec_data + bytes(0x4000))[:0x4000]
-
-        iv = bytearray(16)
-        obj = AES.new(key_result, AES.MODE_CBC, IV=bytes(iv))
-        enc_data = obj.encrypt(bytes(dec_data))[:orig_len]
-        
-        # hash_result
-        # hash is key to generate hash_result
-        kr = aes_cmac(hash, enc_data)
-
-        metadata_offset = 0x100
-        data_offset = metadata_offset + idx * 0x4000 + block_num * 0x10;
-        o.seek(metadata_offset + idx * 0x10)
-        o.write(kr)
-        o.seek(data_offset)
-        o.write(enc_data)
-        
-    o.write(EDAT_FOOTER_V1)
-
-    # forge_data with NPDRM_PSX_KEY
+    metadata_offset = 0x100
     metadata_section_size = 0x10
-    metadata_size = metadata_section_size * block_num
-    metadata = None
-    with open(ofn, 'rb') as oo:
-        oo.seek(metadata_offset)
-        metadata = oo.read(metadata_size)
-    out = metadata
-    test_hash = aes_cmac(NPDRM_PSX_KEY, out)
-    o.seek(0x90)
-    o.write(test_hash)
-
-    header = None
-    with open(ofn, 'rb') as oo:
-        header = oo.read(0xa0)
-
-    header_hash = aes_cmac(NPDRM_PSX_KEY, header)
-    o.seek(0xA0)
-    o.write(header_hash)
-    # qqq random number
-    o.seek(0xb0)
-    o.write(bytes(0x28))
-    # qqq random number
-    o.seek(0xd8)
-    o.write(bytes(0x28))
+    metadata = bytearray(metadata_section_size * block_num)
+    data_offset = metadata_offset + block_num * 0x10
+    end = data_offset
+    o = os.open(ofn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    lock = threading.Lock()
+    try:
+        def encrypt(idx, data):
+            enc_data, kr = encrypt_blocks(npd, idx, data)
+            _pwrite(o, enc_data, data_offset + idx * 0x4000, lock)
+            metadata[idx * 0x10:idx * 0x10 + len(kr)] = kr
+            return data_offset + idx * 0x4000 + len(enc_data)
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            pending = collections.deque()
+            for idx in range(0, block_num, batch):
+                pending.append(pool.submit(encrypt, idx, i.read(batch * 0x4000)))
+                if len(pending) >= threads * 2:
+                    end = pending.popleft().result()
+            while len(pending):
+                end = pending.popleft().result()
+        i.close()
+
+        if block_num:
+            _pwrite(o, EDAT_FOOTER_V1, end, lock)
+
+        # forge_data with NPDRM_PSX_KEY
+        test_hash = aes_cmac(NPDRM_PSX_KEY, metadata)
+        header[0x90:0xa0] = test_hash
+        header_hash = aes_cmac(NPDRM_PSX_KEY, header[:0xa0])
+        header[0xa0:0xb0] = header_hash
+        _pwrite(o, bytes(header + metadata), 0, lock)
+    finally:
+        os.close(o)
@@ -61,6 +61,7 @@ try:
 except:
     True
 from bchunk import bchunk
+from blockcache import blockcache
 from document import create_document, create_document_from_dir, decrypt_document, encrypt_document
 from gamedb import games, libcrypt, themes, ppf_fixes
 from db import disc_by_md5
@@ -68,8 +69,13 @@ try:
     from make_isoedat import pack
 except:
     True
+try:
+    from sign3 import calc_sign
+except:
+    # only needed for PS3, create_ps3() tells the user how to install it
+    calc_sign = None
 from cue import parse_ccd, parse_cue, ccd2cue, write_cue
-from popstation import popstation, GenerateSFO
+from popstation import popstation, GenerateSFO, PBPReader, sharedpayloads
 from ppf import ApplyPPF
 from riff import copy_riff, create_riff, parse_riff
 try:
@@ -2838,12 +2844,20 @@ def get_toc_from_cue(cue_file):
     return toc
 
 
-def generate_pbp(dest_file, disc_ids, game_title, icon0, pic0, pic1, cue_files, img_files, aea_files, snd0=None, whole_disk=True, subchannels=[], configs=None, logo=None, no_pstitleimg=False, subdir = './'):
+def generate_pbp(dest_file, disc_ids, game_title, icon0, pic0, pic1, cue_files, img_files, aea_files, snd0=None, whole_disk=True, subchannels=[], configs=None, logo=None, no_pstitleimg=False, subdir = './', threads=1, block_cache=None, archive=False, shared=None):
     print('Create PBP file for', game_title) if verbose else None
 
     SECTLEN = 2352
     p = popstation()
     p.verbose = verbose
+    p.threads = threads
+    # encode all discs of a multi-disc game at the same time, in the work
+    # directory and not next to the EBOOT.PBP on the memory stick
+    p.parallel_discs = threads > 1
+    p.temp_dir = subdir
+    p.block_cache = block_cache
+    p.archive = archive
+    p.shared = shared
     p.disc_ids = disc_ids
     p.game_title = game_title
     p.subchannels = subchannels
@@ -2888,7 +2902,7 @@ def generate_pbp(dest_file, disc_ids, game_title, icon0, pic0, pic1, cue_files,
         True
 
     
-def create_psp(dest, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue_files, real_cue_files, img_files, mem_cards, aea_files, subdir = './', snd0=None, no_pstitleimg=False, watermark=False, subchannels=[], manual=None, use_cdda=False, logo=None, no_libcrypt=None, psx_undither=None, force_ntsc=False, cdda=False):
+def create_psp(dest, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue_files, real_cue_files, img_files, mem_cards, aea_files, subdir = './', snd0=None, no_pstitleimg=False, watermark=False, subchannels=[], manual=None, use_cdda=False, logo=None, no_libcrypt=None, psx_undither=None, force_ntsc=False, cdda=False, threads=1, block_cache=None, archive=False, shared=None):
     EMPTY_CONFIG = bytes([
         0x70,0x00,0x07,0x06,0x00,0x00,0x06,0x06,0x00,0x00,0x00,0x00,0xFF,0xFF,0xFF,0xFF,
         0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,
@@ -3048,7 +3062,7 @@ def create_psp(dest, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue
     if len(disc_ids) > 1:
         no_pstitleimg = False
 
-    generate_pbp(dest_file, disc_ids, game_title, icon0, pic0, pic1, cue_files, img_files, aea_files, snd0=snd0_data, whole_disk=whole_disk, subchannels=subchannels, configs=configs, logo=logo, no_pstitleimg=no_pstitleimg, subdir=subdir)
+    generate_pbp(dest_file, disc_ids, game_title, icon0, pic0, pic1, cue_files, img_files, aea_files, snd0=snd0_data, whole_disk=whole_disk, subchannels=subchannels, configs=configs, logo=logo, no_pstitleimg=no_pstitleimg, subdir=subdir, threads=threads, block_cache=block_cache, archive=archive, shared=shared)
 
     if manual:
         print('Installing manual as', f + '/DOCUMENT.DAT')
@@ -3080,7 +3094,7 @@ def create_psp(dest, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue
             True
 
 
-def create_psc(dest, disc_ids, game_title, icon0, pic1, cue_files, img_files, watermark=True, subdir = './'):
+def create_psc(dest, disc_ids, game_title, icon0, pic1, cue_files, img_files, watermark=True, subdir = './', threads=1, block_cache=None, shared=None):
     print('Create PS Classics/AutoBleem EBOOT.PBP for', game_title) if verbose else None
 
     # Convert ICON0 to a file object
@@ -3104,7 +3118,7 @@ def create_psc(dest, disc_ids, game_title, icon0, pic1, cue_files, img_files, wa
     
     dest_file = dest + '/Games/' + game_title + '.PBP'
     print('Install EBOOT as', dest_file) if verbose else None
-    generate_pbp(dest_file, disc_ids, game_title, icon0, None, pic1, cue_files, img_files, [], None, subdir=subdir)
+    generate_pbp(dest_file, disc_ids, game_title, icon0, None, pic1, cue_files, img_files, [], None, subdir=subdir, threads=threads, block_cache=block_cache, shared=shared)
 
     try:
         os.sync()
@@ -3130,6 +3144,8 @@ def create_ps3(dest, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue
         return c
 
     print('Create PS3 PKG for', game_title) if verbose else None
+    if calc_sign is None:
+        raise Exception('ecdsa is not installed. It is needed to sign PS3 packages.\nYou should install ecdsa by running:\npip3 install ecdsa')
 
     if not no_libcrypt:
         try:
@@ -3355,26 +3371,21 @@ def create_ps3(dest, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue
         copy_file(manual, subdir + disc_ids[0] + '/USRDIR/CONTENT/DOCUMENT.DAT')
 
     p.eboot = subdir + disc_ids[0] + '/USRDIR/CONTENT/EBOOT.PBP'
-    p.iso_bin_dat = subdir + disc_ids[0] + '/USRDIR/ISO.BIN.DAT'
-    try:
-        os.unlink(p.iso_bin_dat)
-    except:
-        True
+    # The ISO.BIN.DAT is built in memory, signed and then encrypted
+    # straight into ISO.BIN.EDAT without ever being written to disk.
+    iso_bin_dat = io.BytesIO()
+    p.iso_bin_dat = iso_bin_dat
     print('Create EBOOT.PBP at', p.eboot)
     p.create_pbp()
     temp_files.append(p.eboot)
-    temp_files.append(p.iso_bin_dat)
     try:
         os.sync()
     except:
         True
 
     # sign the ISO.BIN.DAT
-    print('Signing', p.iso_bin_dat)
-    if os.name == 'posix':
-        subprocess.call(['python3', './sign3.py', p.iso_bin_dat])
-    else:
-        subprocess.call(['sign3.exe', p.iso_bin_dat])
+    print('Signing ISO.BIN.DAT')
+    iso_bin_dat.write(calc_sign(p.iso_bin_dat_sha1))
 
     #
     # USRDIR/SAVEDATA
@@ -3445,7 +3456,7 @@ def create_ps3(dest, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue
     # Create ISO.BIN.EDAT
     #
     print('Create ISO.BIN.EDAT')
-    pack(subdir + '%s/USRDIR/ISO.BIN.DAT' % disc_ids[0],
+    pack(iso_bin_dat.getbuffer(),
          subdir + '%s/USRDIR/ISO.BIN.EDAT' % disc_ids[0],
          'UP9000-%s_00-0000000000000001' % disc_ids[0])
     temp_files.append(subdir + '%s/USRDIR/ISO.BIN.EDAT' % disc_ids[0])
@@ -3580,7 +3591,12 @@ def find_psc_mount():
     raise Exception('Could not find any PS Classic/AutoBleem devices')
 
 
-def create_blank_mc(mc):
+def fsync_file(path):
+    with open(path, 'ab') as f:
+        os.fsync(f.fileno())
+
+
+def create_blank_mc(mc, fsync=False):
     with open(mc, "wb") as f:
         f.seek(131071)
         f.write(bytes(1))
@@ -3618,9 +3634,12 @@ def create_blank_mc(mc):
         for i in range(0x880, 0x1190, 0x80):
             f.seek(i)
             f.write(buf)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
 
             
-def create_ps2(dest, disc_ids, game_title, icon0, pic1, cue_files, img_files, subdir = './'):
+def create_ps2(dest, disc_ids, game_title, icon0, pic1, cue_files, img_files, subdir = './', threads=1, fsync=False):
     print('Create PS2 VCD for', game_title) if verbose else None
     print('Install VCD in', dest + '/POPS')
 
@@ -3637,6 +3656,8 @@ def create_ps2(dest, disc_ids, game_title, icon0, pic1, cue_files, img_files, su
     p.verbose = verbose
     p.disc_ids = disc_ids
     p.game_title = game_title
+    p.threads = threads
+    p.fsync = fsync
 
     discs_txt = None
     vmcdir_txt = None
@@ -3654,13 +3675,13 @@ def create_ps2(dest, disc_ids, game_title, icon0, pic1, cue_files, img_files, su
             else:
                 discs_txt = discs_txt + pp
 
+    vcds = []
     for i in range(len(img_files)):
         f = img_files[i]
         print('Need to create a TOC') if verbose else None
         toc = get_toc_from_cue(cue_files[i])
 
         print('Add image', f) if verbose else None
-        p.add_img((f, toc))
 
         print('GameID', game_id, game_title) if verbose else None
         pp = dest + '/POPS/' + game_id[:4] + '_' + game_id[4:7] + '.' + game_id[7:9] + '.' + game_title
@@ -3670,35 +3691,43 @@ def create_ps2(dest, disc_ids, game_title, icon0, pic1, cue_files, img_files, su
             os.mkdir(pp)
         except:
             True
-        p.vcd = pp + '.VCD'
-        print('Create VCD at', p.vcd) if verbose else None
-        p.create_vcd()
-        try:
-            os.sync()
-        except:
-            True
+        print('Create VCD at', pp + '.VCD') if verbose else None
+        vcds.append(((f, toc), pp + '.VCD'))
 
         if discs_txt:
             with open(pp + '/DISCS.TXT', 'w') as f:
                 f.write(discs_txt)
+            fsync_file(pp + '/DISCS.TXT') if fsync else None
         if vmcdir_txt:
             with open(pp + '/VMCDIR.TXT', 'w') as f:
                 f.write(vmcdir_txt)
+            fsync_file(pp + '/VMCDIR.TXT') if fsync else None
 
 
         if i == 0:
-            create_blank_mc(pp + '/SLOT0.VMC')
-            create_blank_mc(pp + '/SLOT1.VMC')
+            create_blank_mc(pp + '/SLOT0.VMC', fsync=fsync)
+            create_blank_mc(pp + '/SLOT1.VMC', fsync=fsync)
+
+    # write all the discs at the same time
+    p.create_vcds(vcds)
             
     pp = dest + '/ART/'
     f = pp + game_id[0:4] + '_' + game_id[4:7] + '.' + game_id[7:9] + '_COV.jpg'
     image = icon0.resize((200, 200))
     image = image.convert('RGB')
     image.save(f, format='JPEG', quality=100, subsampling=0)
+    fsync_file(f) if fsync else None
     f = pp + game_id[0:4] + '_' + game_id[4:7] + '.' + game_id[7:9] + '_BG.jpg'
     image = pic1.resize((640, 480))
     image = image.convert('RGB')
     image.save(f, format='JPEG', quality=100, subsampling=0)
+    fsync_file(f) if fsync else None
+
+    if not fsync:
+        try:
+            os.sync()
+        except:
+            True
 
 
 def get_disc_id(cue, real_cue_file, tmp, is_psp=False):
@@ -4357,9 +4386,45 @@ def generate_aea_files(cue_files, img_files, subdir):
     return aea_files, extra_data_track_found
 
 
-def process_disk_file(cue_file, idx, temp_files, subdir='./'):
+# Decompress one disc of an EBOOT.PBP into a temporary bin/cue
+def extract_pbp_disc(pbp_file, disc_num, idx, temp_files, subdir='./', threads=1):
+    tmpbin = subdir + 'PBP%d.bin' % (idx)
+    tmpcue = subdir + 'PBP%d.cue' % (idx)
+    tmptoc = subdir + 'PBP%d.toc' % (idx)
+    temp_files.append(tmpbin)
+    temp_files.append(tmpcue)
+    temp_files.append(tmptoc)
+    with PBPReader(pbp_file) as pbp:
+        disc = pbp.disc(disc_num)
+    print('Extracting disc', disc_num, 'from', pbp_file, 'to', tmpbin) if verbose else None
+    p = popstation()
+    p.verbose = verbose
+    p.threads = threads
+    p.dump_to_img(pbp_file, os.path.abspath(tmpbin), tmpcue, tmptoc, offset=disc['offset'])
+    if disc['tracks']:
+        # The CDDA tracks were converted to ATRAC3 when the EBOOT was
+        # created and are not in the image so we can only use the data
+        # track.
+        print('Disc %d in %s has its audio tracks stored as ATRAC3. They can not be converted back to CDDA so only the data track is used.' % (disc_num, pbp_file))
+        with open(tmpcue, 'w') as f:
+            f.write('FILE "%s" BINARY\n' % os.path.abspath(tmpbin))
+            f.write('  TRACK 01 MODE2/2352\n')
+            f.write('    INDEX 01 00:00:00\n')
+        # and the TOC still lists the audio tracks
+        os.unlink(tmptoc)
+    return tmpcue
+
+
+def process_disk_file(cue_file, idx, temp_files, subdir='./', disc_num=0, threads=1):
     real_cue_file = cue_file
 
+    if cue_file[-4:].lower() == '.pbp':
+        print('This is an EBOOT.PBP. Extract disc', disc_num) if verbose else None
+        cue_file = extract_pbp_disc(cue_file, disc_num, idx, temp_files, subdir=subdir, threads=threads)
+        # we didn't actually have a CUE file to start with so just
+        # replace the "real" cue filename with our temporary one
+        real_cue_file = cue_file
+
     if cue_file[-4:].lower() == '.chd':
         print('This is a CHD file. Uncompress the file.') if verbose else None
         chd = cue_file
@@ -4532,6 +4597,10 @@ if __name__ == "__main__":
     parser.add_argument('--psp-use-cdda', action='store_true', help='Use CDDA instead of ATRAC3 for audio tracks on PSP')
     parser.add_argument('--ps2-dir',
                     help='Where the PS2 USB-stick is mounted')
+    parser.add_argument('--ps2-fsync', action='store_true',
+                    help='fsync() every VCD, memory card, text file and '
+                    'image as soon as it has been written instead of '
+                    'syncing once everything is done')
     parser.add_argument('--ps3-pkg',
                     help='Name of the PS3 pckage to create')
     parser.add_argument('--psc-dir',
@@ -4575,12 +4644,27 @@ if __name__ == "__main__":
                     help='Use the ps1_newemu emulator (only valid for PS3 PKG, overrides other configs)')
     parser.add_argument('--swap-discs', action='store_true',
                     help='Enable swap_discs option (only valid for PS3 PKG)')
+    parser.add_argument('--threads', type=int,
+                        help='Number of threads to use when compressing disc images. Default is the number of CPUs.')
+    parser.add_argument('--archive', action='store_true',
+                        help='Try several compression settings for every disc block and keep the smallest. Slow but gives smaller PSP EBOOTs.')
+    parser.add_argument('--block-cache',
+                        help='Cache compressed disc blocks in this file so that later builds of the same disc can reuse them')
+    parser.add_argument('--block-cache-size', type=int, default=2048,
+                        help='Maximum size of the block cache in MB. Default is 2048.')
     parser.add_argument('files', nargs='*')
     args = parser.parse_args()
 
     if args.v:
         verbose = True
 
+    if not args.threads:
+        args.threads = os.cpu_count() or 1
+
+    block_cache = None
+    if args.block_cache:
+        block_cache = blockcache(args.block_cache, args.block_cache_size * 1024 * 1024)
+
     if args.list_themes:
         for theme in themes:
             print(theme, ':', themes[theme]['description'], 'AUTO' if 'url' not in themes[theme] else themes[theme]['url'])
@@ -4639,17 +4723,26 @@ if __name__ == "__main__":
         zip = None
         print('Processing', cue_file, '...')
 
-        cue_file , real_cue_file, img_file = process_disk_file(cue_file, 0 if not idx else idx[0], temp_files, subdir=subdir)
+        # an EBOOT.PBP can contain several discs
+        discs = [0]
+        if cue_file[-4:].lower() == '.pbp':
+            with PBPReader(cue_file) as pbp:
+                discs = range(pbp.num_discs)
+            if len(discs) > 1 and not idx:
+                idx = (1, len(discs))
 
-        if not cue_file:
-            continue
+        for disc_num in discs:
+            _cue_file , real_cue_file, img_file = process_disk_file(cue_file, 0 if not idx else idx[0], temp_files, subdir=subdir, disc_num=disc_num, threads=args.threads)
+
+            if not _cue_file:
+                continue
 
-        img_files.append(img_file)
-        cue_files.append(cue_file)
-        real_cue_files.append(real_cue_file)
+            img_files.append(img_file)
+            cue_files.append(_cue_file)
+            real_cue_files.append(real_cue_file)
 
-        if idx:
-            idx = (idx[0] + 1, idx[1])
+            if idx:
+                idx = (idx[0] + 1, idx[1])
 
     # We need to convert the first track of every ISO so we can open the
     # disk and read system.cnf
@@ -4849,14 +4942,18 @@ if __name__ == "__main__":
         print('Disable SND0')
         snd0 = None
 
+    # When we build several EBOOT.PBPs from the same images we only
+    # compress every disc once and copy the blocks into the others from
+    # the work dir, not back from the memory stick.
+    shared = sharedpayloads(subdir)
     if args.psp_dir:
-        create_psp(args.psp_dir, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue_files, real_cue_files, img_files, mem_cards, aea_files, snd0=snd0, subdir=subdir, watermark=args.watermark, subchannels=subchannels, manual=psp_manual, use_cdda=args.psp_use_cdda, logo=logo, no_libcrypt=args.no_libcrypt, psx_undither=args.psx_undither)
+        create_psp(args.psp_dir, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue_files, real_cue_files, img_files, mem_cards, aea_files, snd0=snd0, subdir=subdir, watermark=args.watermark, subchannels=subchannels, manual=psp_manual, use_cdda=args.psp_use_cdda, logo=logo, no_libcrypt=args.no_libcrypt, psx_undither=args.psx_undither, threads=args.threads, block_cache=block_cache, archive=args.archive, shared=shared)
     if args.ps2_dir:
-        create_ps2(args.ps2_dir, disc_ids, game_title, icon0, pic1, cue_files, img_files, subdir=subdir)
+        create_ps2(args.ps2_dir, disc_ids, game_title, icon0, pic1, cue_files, img_files, subdir=subdir, threads=args.threads, fsync=args.ps2_fsync)
     if args.ps3_pkg:
         create_ps3(args.ps3_pkg, disc_ids, real_disc_ids, game_title, icon0, pic0, pic1, cue_files, real_cue_files, img_files, mem_cards, aea_files, magic_word, resolution, snd0=snd0, subdir=subdir, whole_disk=args.whole_disk, subchannels=subchannels, manual=ps3_manual, no_libcrypt=args.no_libcrypt, psx_undither=args.psx_undither, ps1_newemu=args.ps1_newemu, enable_swap=args.swap_discs)
     if args.psc_dir:
-        create_psc(args.psc_dir, disc_ids, game_title, icon0, pic1, cue_files, img_files, watermark=True if args.watermark else False, subdir=subdir)
+        create_psc(args.psc_dir, disc_ids, game_title, icon0, pic1, cue_files, img_files, watermark=True if args.watermark else False, subdir=subdir, threads=args.threads, block_cache=block_cache, shared=shared)
     if args.fetch_metadata:
         create_metadata(args.files[0], disc_ids[0], game_title, icon0, pic0, pic1, snd0, manual)
     if args.psio_dir:
@@ -4883,9 +4980,12 @@ if __name__ == "__main__":
             i.seek(0)
             pic1 = i.read()
         
-        generate_pbp(new_path, disc_ids, game_title, icon0, None, pic1, cue_files, img_files, aea_files, None, subdir=subdir)
+        generate_pbp(new_path, disc_ids, game_title, icon0, None, pic1, cue_files, img_files, aea_files, None, subdir=subdir, threads=args.threads, block_cache=block_cache, shared=shared)
     if args.retroarch_thumbnail_dir:
         create_retroarch_thumbnail(args.retroarch_thumbnail_dir, game_title, icon0, pic1)
+    if block_cache:
+        block_cache.close()
+    shared.close()
 
     for f in temp_files:
         print('Deleting temp file', f) if verbose else None
@@ -11,16 +11,25 @@
 #
 
 import argparse
+import collections
 import configparser
 import datetime
 import hashlib
 import io
+import json
 import os
+import queue
 import re
 import struct
 import sys
+import tempfile
+import threading
+import time
 import zlib
 
+from blockcache import blockcache
+from concurrent.futures import ThreadPoolExecutor
+from deflate_backends import archive_backend, get_backend
 from gamedb import games
 
 _basic_toc = bytes([
@@ -2263,6 +2272,215 @@ _datapspbody = bytes([
 PSP_OFFSET = 0x20
 PSAR_OFFSET = 0x24
 
+# Like map() but runs func on a pool of threads, or on pool if it is set.
+# Results come back in order and at most depth items are in flight.
+# zlib and hashlib release the GIL so threads are enough.
+def ordered_map(func, iterable, threads, depth=None, pool=None):
+    if threads <= 1 and pool is None:
+        yield from map(func, iterable)
+        return
+    if not depth:
+        depth = max(threads, 1) * 4
+    if pool is not None:
+        yield from _ordered_submit(pool, func, iterable, depth)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        yield from _ordered_submit(pool, func, iterable, depth)
+
+
+def _ordered_submit(pool, func, iterable, depth):
+    pending = collections.deque()
+    for i in iterable:
+        pending.append(pool.submit(func, i))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while len(pending):
+        yield pending.popleft().result()
+
+
+# Copy size bytes from offset in fi to fo, with copy_file_range() or
+# sendfile() when both are real files
+def copy_range(fi, offset, size, fo, chunk_size=1048576):
+    n = 0
+    try:
+        fo.flush()
+        fd_in = fi.fileno()
+        fd_out = fo.fileno()
+        pos = fo.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fd_in = None
+    if fd_in is not None and hasattr(os, 'copy_file_range'):
+        try:
+            while n < size:
+                _n = os.copy_file_range(fd_in, fd_out, size - n, offset + n, pos + n)
+                if not _n:
+                    break
+                n = n + _n
+        except OSError:
+            True
+    if fd_in is not None and n < size and hasattr(os, 'sendfile'):
+        try:
+            os.lseek(fd_out, pos + n, 0)
+            while n < size:
+                _n = os.sendfile(fd_out, fd_in, offset + n, size - n)
+                if not _n:
+                    break
+                n = n + _n
+        except OSError:
+            True
+    if fd_in is not None:
+        # make sure the python file object knows where we are
+        fo.seek(pos + n)
+    fi.seek(offset + n)
+    while n < size:
+        buf = fi.read(min(size - n, chunk_size))
+        if not buf:
+            raise Exception('Short read copying %d bytes at offset %d' % (size, offset))
+        fo.write(buf)
+        n = n + len(buf)
+
+
+# Reads a file in chunks from a separate thread so reading overlaps with
+# compression. A chunk buffer is reused once it has been release()d.
+class readahead(object):
+    def __init__(self, fi, size, chunk_size, depth, inflight=0):
+        self._fi = fi
+        self._size = size
+        self._chunk_size = max(chunk_size - chunk_size % 0x9300, 0x9300)
+        self._q = queue.Queue(depth)
+        self._free = queue.Queue()
+        # depth chunks in the queue, the ones holding the blocks the
+        # consumer has in flight and a few spare
+        _bpc = int(self._chunk_size / 0x9300)
+        for i in range(depth + 3 + int((inflight + _bpc - 1) / _bpc)):
+            self._free.put(bytearray(self._chunk_size))
+        self._error = None
+        self._stop = False
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        try:
+            pos = 0
+            while pos < self._size:
+                buf = self._free.get()
+                if buf is None or self._stop:
+                    break
+                _m = memoryview(buf)[:min(self._chunk_size, self._size - pos)]
+                n = 0
+                while n < len(_m):
+                    _n = self._fi.readinto(_m[n:])
+                    if not _n:
+                        break
+                    n = n + _n
+                if not n:
+                    break
+                self._q.put((buf, n))
+                if n < len(_m):
+                    break
+                pos = pos + n
+        except Exception as e:
+            self._error = e
+        finally:
+            self._q.put(None)
+
+    def chunks(self):
+        while True:
+            c = self._q.get()
+            if c is None:
+                break
+            yield c
+        if self._error:
+            raise self._error
+
+    def release(self, buf):
+        self._free.put(buf)
+
+    def close(self):
+        # unblock the reader if it is still waiting on us
+        self._stop = True
+        self._free.put(None)
+        while self._thread.is_alive():
+            try:
+                self._q.get(timeout=0.1)
+            except queue.Empty:
+                True
+        self._thread.join()
+
+
+# A file that can only be written in order, like a pipe or a socket
+class streamwriter(object):
+    def __init__(self, fh):
+        self._fh = fh
+        self._pos = 0
+
+    def write(self, b):
+        self._fh.write(b)
+        self._pos = self._pos + len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        raise io.UnsupportedOperation('Can not seek in stream mode')
+
+    def flush(self):
+        self._fh.flush()
+
+    def close(self):
+        self._fh.close()
+
+
+# Queues the writes and does them in large chunks from a separate thread
+class writebehind(object):
+    def __init__(self, fh, chunk_size, depth):
+        self._fh = fh
+        self._chunk_size = chunk_size
+        self._buf = bytearray()
+        self._q = queue.Queue(depth)
+        self._error = None
+        self._aborted = False
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            b = self._q.get()
+            if b is None:
+                break
+            if self._error or self._aborted:
+                continue
+            try:
+                self._fh.write(b)
+            except Exception as e:
+                self._error = e
+
+    def write(self, b):
+        if self._error:
+            raise self._error
+        self._buf += b
+        if len(self._buf) >= self._chunk_size:
+            self._q.put(self._buf)
+            self._buf = bytearray()
+
+    def close(self):
+        if len(self._buf):
+            self._q.put(self._buf)
+            self._buf = bytearray()
+        self._q.put(None)
+        self._thread.join()
+        if self._error:
+            raise self._error
+
+    def abort(self):
+        # drop whatever has not been written yet and stop the thread
+        self._aborted = True
+        self._buf = bytearray()
+        self._q.put(None)
+        self._thread.join()
+
+
 def ParseSFO(sfo_buf):
     SFO_HEADER_SIZE = 0x14
     INDEX_ENTRY_SIZE = 0x10
@@ -2369,6 +2587,258 @@ def GenerateSFO(sfo):
     return hdr + index + keys + data
 
 
+# Where the compressed blocks of every disc were written, so other
+# EBOOT.PBPs built from the same image and settings can copy them instead
+# of compressing the image again. With work_dir they are kept in files there.
+class sharedpayloads(object):
+    def __init__(self, work_dir=None):
+        self._payloads = {}
+        self._lock = threading.Lock()
+        self._work_dir = work_dir
+        self._files = []
+
+    @property
+    def work_dir(self):
+        return self._work_dir
+
+    def new_file(self):
+        # a file in work_dir for the blocks of one disc, removed by close()
+        f = tempfile.NamedTemporaryFile(dir=self._work_dir, prefix='payload-',
+                                        suffix='.bin', delete=False)
+        with self._lock:
+            self._files.append(f.name)
+        return f
+
+    # (file, offset, size, index table) or None
+    def get(self, key):
+        with self._lock:
+            return self._payloads.get(key)
+
+    def put(self, key, path, offset, size, indexes):
+        with self._lock:
+            self._payloads[key] = (path, offset, size, bytes(indexes))
+
+    # path is about to be overwritten
+    def forget(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [k for k, v in self._payloads.items() if v[0] == path]:
+                del self._payloads[key]
+
+    def close(self):
+        with self._lock:
+            self._payloads = {}
+            for f in self._files:
+                try:
+                    os.unlink(f)
+                except OSError:
+                    True
+            self._files = []
+
+
+# Read only access to an existing EBOOT.PBP. Blocks are only inflated when
+# they are read and the most recently used ones are cached.
+class PBPReader(object):
+    def __init__(self, eboot, cache_blocks=64, strict=True):
+        self._fh = open(eboot, 'rb')
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._cache_blocks = cache_blocks
+
+        buf = self._fh.read(0x28)
+        if buf[0:4] != b'\x00PBP':
+            self._fh.close()
+            raise Exception('Not a PBP file')
+        self._header = {}
+        for i, name in enumerate(['sfo', 'icon0', 'icon1', 'pic0', 'pic1',
+                                  'snd0', 'datapsp', 'datapsar']):
+            self._header[name] = struct.unpack_from('<I', buf, 8 + i * 4)[0]
+
+        # A single disc PBP can have the PSISOIMG right at the start of
+        # the PSAR, otherwise PSTITLEIMG has the offsets of all the discs.
+        psar = self._header['datapsar']
+        buf = self.pread(psar, 0x400)
+        self._psiso_offsets = []
+        self._startdat = None
+        if buf[:16] == b'PSTITLEIMG000000':
+            # there is room for 5 discs
+            for i in range(0x200, 0x214, 4):
+                _off = struct.unpack_from('<I', buf, i)[0]
+                if _off == 0:
+                    break
+                self._psiso_offsets.append(psar + _off)
+            self._startdat = psar + struct.unpack_from('<I', buf, 0x10)[0]
+        elif buf[:12] == b'PSISOIMG0000':
+            self._psiso_offsets.append(psar)
+        else:
+            self._fh.close()
+            raise Exception('Unknown section in EBOOT.PBP', buf[:16])
+
+        self._discs = []
+        for psiso in self._psiso_offsets:
+            try:
+                self._discs.append(self.read_psiso_header(psiso))
+            except Exception:
+                if strict:
+                    self._fh.close()
+                    raise
+                self._discs.append(None)
+
+    # list of (offset, length, flags, SHA1), the offsets are relative to
+    # psiso + 0x100000
+    @staticmethod
+    def index_table(fh, psiso):
+        fh.seek(psiso + 0x12d4)
+        # the subchannel blob, if any, follows the index table
+        _end = struct.unpack_from('<I', fh.read(4).ljust(4, b'\x00'), 0)[0]
+        if _end <= 0x4000 or _end > 0x100000:
+            _end = 0x100000
+        # read the whole index table in one go
+        fh.seek(psiso + 0x4000)
+        buf = fh.read(_end - 0x4000)
+        index = []
+        for _off, _len, _flags, digest in struct.iter_unpack('<IHBx16s8x', buf[:len(buf) & ~0x1f]):
+            if _len == 0:
+                break
+            index.append((_off, _len, _flags, digest))
+        return index
+
+    def read_psiso_header(self, psiso):
+        buf = self.pread(psiso, 0x4000)
+        if buf[:12] != b'PSISOIMG0000':
+            raise Exception('No PSISOIMG at offset 0x%08x' % psiso)
+        disc = {}
+        disc['offset'] = psiso
+        disc['length'] = struct.unpack_from('<I', buf, 12)[0]
+        disc['length_1220'] = struct.unpack_from('<I', buf, 0x1220)[0]
+        disc['disc_id'] = buf[0x400:0x40b].decode('utf-8', errors='replace')
+        disc['toc'] = buf[0x800:0xc00]
+        # audio tracks table, there is room for 98 tracks
+        disc['tracks'] = []
+        for i in range(98):
+            _off, _len = struct.unpack_from('<II', buf, 0xc00 + i * 16)
+            if _off == 0:
+                break
+            disc['tracks'].append((psiso + 0x100000 + _off, _len))
+        with self._lock:
+            index = PBPReader.index_table(self._fh, psiso)
+        disc['index'] = [(psiso + 0x100000 + _off, _len, digest) for _off, _len, _flags, digest in index]
+        disc['size'] = len(disc['index']) * 0x9300
+        return disc
+
+    def pread(self, offset, size):
+        with self._lock:
+            self._fh.seek(offset)
+            return self._fh.read(size)
+
+    @property
+    def header(self):
+        return self._header
+
+    @property
+    def sfo(self):
+        return ParseSFO(self.pread(self._header['sfo'], self._header['icon0'] - self._header['sfo']))['parameters']
+
+    def asset(self, name):
+        names = ['sfo', 'icon0', 'icon1', 'pic0', 'pic1', 'snd0', 'datapsp', 'datapsar']
+        _start = self._header[name]
+        _end = self._header[names[names.index(name) + 1]]
+        if _start == _end:
+            return None
+        return self.pread(_start, _end - _start)
+
+    @property
+    def psiso_offsets(self):
+        return self._psiso_offsets
+
+    @property
+    def startdat(self):
+        return self._startdat
+
+    @property
+    def num_discs(self):
+        return len(self._discs)
+
+    def disc(self, disc_num):
+        return self._discs[disc_num]
+
+    # (block number, compressed block, SHA1 from the index) for every block
+    def payloads(self, disc_num):
+        for block, (_off, _len, digest) in enumerate(self._discs[disc_num]['index']):
+            buf = self.pread(_off, _len)
+            if not buf:
+                break
+            yield block, buf, digest
+
+    def read_block(self, disc_num, block):
+        key = (disc_num, block)
+        with self._lock:
+            buf = self._cache.get(key)
+            if buf is not None:
+                self._cache.move_to_end(key)
+                return buf
+        _off, _len, digest = self._discs[disc_num]['index'][block]
+        buf = self.pread(_off, _len)
+        if _len < 0x9300:
+            buf = zlib.decompress(buf, wbits=-15)
+        with self._lock:
+            self._cache[key] = buf
+            while len(self._cache) > self._cache_blocks:
+                self._cache.popitem(last=False)
+        return buf
+
+    # seekable file object over the decompressed image
+    def open_disc(self, disc_num):
+        return io.BufferedReader(PBPDiscReader(self, disc_num), buffer_size=0x9300)
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PBPDiscReader(io.RawIOBase):
+    def __init__(self, pbp, disc_num):
+        self._pbp = pbp
+        self._disc_num = disc_num
+        self._size = pbp.disc(disc_num)['size']
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset = self._pos + offset
+        if whence == 2:
+            offset = self._size + offset
+        if offset < 0:
+            raise ValueError('Negative seek position %d' % offset)
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b):
+        if self._pos >= self._size:
+            return 0
+        block = int(self._pos / 0x9300)
+        _o = self._pos - block * 0x9300
+        buf = self._pbp.read_block(self._disc_num, block)
+        n = min(len(b), len(buf) - _o, self._size - self._pos)
+        b[:n] = buf[_o:_o + n]
+        self._pos = self._pos + n
+        return n
+
+
 class popstation(object):
     _sfo = {
         'BOOTABLE': {
@@ -2409,6 +2879,7 @@ class popstation(object):
     def __init__(self):
         self._eboot = 'EBOOT.PBP'
         self._iso_bin_dat = None
+        self._iso_bin_dat_sha1 = None
         self._vcd = 'GAME.VCD'
         self._img_toc = []
         self._track0_size = []
@@ -2419,6 +2890,28 @@ class popstation(object):
         self._hotfixes = None
         self._verbose = False
         self._striptracks = False
+        self._threads = 1
+        self._block_cache = None
+        self._constant_blocks = {}
+        # None means stdlib zlib, see select_backend()
+        self._deflate_backend = None
+        self._backend = None
+        self._archive = False
+        self._skip_incompressible = False
+        self._chunk_size = 0x9300 * 32
+        self._queue_depth = 4
+        self._stream = False
+        self._parallel_discs = False
+        self._temp_dir = None
+        # the compression pool that all discs share with parallel_discs
+        self._pool = None
+        self._dedup = False
+        self._check_blocks = False
+        self._dump_psiso_dat = False
+        self._shared = None
+        self._fsync = False
+        self._stats_lock = threading.Lock()
+        self._stats = collections.Counter()
         # complevel is >0 for PSP and ==0 for PS3
         self._complevel = 1
         self._no_pstitleimg = False
@@ -2577,6 +3070,12 @@ class popstation(object):
     @iso_bin_dat.setter
     def iso_bin_dat(self, value):
         self._iso_bin_dat = value
+
+    # pass this to sign3.calc_sign() so we do not have to read the
+    # ISO.BIN.DAT back
+    @property
+    def iso_bin_dat_sha1(self):
+        return self._iso_bin_dat_sha1
         
     @property
     def vcd(self):
@@ -2610,6 +3109,135 @@ class popstation(object):
     def striptracks(self, value):
         self._striptracks = value
 
+    @property
+    def threads(self):
+        return self._threads
+
+    @threads.setter
+    def threads(self, value):
+        self._threads = value
+
+    @property
+    def stats(self):
+        return self._stats
+
+    # safe to call from the workers
+    def count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] = self._stats[key] + n
+
+    @property
+    def archive(self):
+        return self._archive
+
+    @archive.setter
+    def archive(self, value):
+        self._archive = value
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    @chunk_size.setter
+    def chunk_size(self, value):
+        self._chunk_size = value
+
+    @property
+    def queue_depth(self):
+        return self._queue_depth
+
+    @queue_depth.setter
+    def queue_depth(self, value):
+        self._queue_depth = value
+
+    @property
+    def dump_psiso_dat(self):
+        return self._dump_psiso_dat
+
+    @dump_psiso_dat.setter
+    def dump_psiso_dat(self, value):
+        self._dump_psiso_dat = value
+
+    @property
+    def check_blocks(self):
+        return self._check_blocks
+
+    @check_blocks.setter
+    def check_blocks(self, value):
+        self._check_blocks = value
+
+    @property
+    def fsync(self):
+        return self._fsync
+
+    @fsync.setter
+    def fsync(self, value):
+        self._fsync = value
+
+    @property
+    def shared(self):
+        return self._shared
+
+    @shared.setter
+    def shared(self, value):
+        self._shared = value
+
+    @property
+    def dedup(self):
+        return self._dedup
+
+    @dedup.setter
+    def dedup(self, value):
+        self._dedup = value
+
+    @property
+    def stream(self):
+        return self._stream
+
+    @stream.setter
+    def stream(self, value):
+        self._stream = value
+
+    @property
+    def parallel_discs(self):
+        return self._parallel_discs
+
+    @parallel_discs.setter
+    def parallel_discs(self, value):
+        self._parallel_discs = value
+
+    @property
+    def temp_dir(self):
+        return self._temp_dir
+
+    @temp_dir.setter
+    def temp_dir(self, value):
+        self._temp_dir = value
+
+    @property
+    def skip_incompressible(self):
+        return self._skip_incompressible
+
+    @skip_incompressible.setter
+    def skip_incompressible(self, value):
+        self._skip_incompressible = value
+
+    @property
+    def deflate_backend(self):
+        return self._deflate_backend
+
+    @deflate_backend.setter
+    def deflate_backend(self, value):
+        self._deflate_backend = value
+
+    @property
+    def block_cache(self):
+        return self._block_cache
+
+    @block_cache.setter
+    def block_cache(self, value):
+        self._block_cache = value
+
     def get_toc_from_ccd(self, img):
         def bcd(i):
             return int(i % 10) + 16 * (int(i / 10) % 10)
@@ -2657,7 +3285,149 @@ class popstation(object):
             data = data + buf
         return data
 
-    def dump_to_img(self, dat, img, cue, toc):
+    # (block number, compressed block, SHA1 from the index) for every block
+    # of the PSISOIMG at offset in i
+    def read_payloads(self, i, offset=0):
+        for block, (_off, _len, _flags, digest) in enumerate(PBPReader.index_table(i, offset)):
+            i.seek(offset + 0x100000 + _off)
+            buf = i.read(_len)
+            if not buf:
+                break
+            yield block, buf, digest
+
+    def inflate_block(self, payload):
+        block, buf, digest = payload
+        if len(buf) < 0x9300:
+            buf = zlib.decompress(buf, wbits=-15)
+        if self._check_blocks and hashlib.sha1(buf).digest()[:16] != digest:
+            raise Exception('Block %d does not match the SHA1 in the index table' % block)
+        return buf
+
+    # Runs in the worker threads.
+    # Returns (block number, None) or (block number, what is wrong).
+    def check_block(self, payload):
+        block, buf, digest = payload
+        try:
+            if len(buf) > 0x9300:
+                return block, 'block is %d bytes' % len(buf)
+            if len(buf) < 0x9300:
+                buf = zlib.decompress(buf, wbits=-15)
+            if len(buf) != 0x9300:
+                return block, 'block inflates to %d bytes' % len(buf)
+        except zlib.error as e:
+            return block, 'can not inflate block: %s' % e
+        if hashlib.sha1(buf).digest()[:16] != digest:
+            return block, 'SHA1 does not match the index table'
+        return block, None
+
+    # Check the structure of an EBOOT.PBP and the SHA1 of every block.
+    # Returns a report that can be serialized to JSON.
+    def verify_pbp(self, eboot):
+        report = {'file': eboot, 'ok': False, 'errors': [], 'discs': []}
+        errors = report['errors']
+        try:
+            size = os.stat(eboot).st_size
+            report['size'] = size
+            pbp = PBPReader(eboot, cache_blocks=0, strict=False)
+        except OSError as ex:
+            errors.append(str(ex))
+            return report
+        except Exception as ex:
+            errors.append(ex.args[0] if ex.args else str(ex))
+            return report
+        with pbp:
+            offsets = list(pbp.header.values())
+            for i in range(len(offsets) - 1):
+                if offsets[i] > offsets[i + 1]:
+                    errors.append('PBP header offsets are not in order')
+            psar = pbp.header['datapsar']
+            report['psar'] = psar
+            try:
+                pbp.sfo
+            except Exception as ex:
+                errors.append('Bad PARAM.SFO: %s' % ex)
+            if not pbp.num_discs:
+                errors.append('PSTITLEIMG has no discs')
+
+            _end = psar
+            for disc_num, psiso in enumerate(pbp.psiso_offsets):
+                disc = {'disc': disc_num, 'offset': psiso, 'errors': []}
+                report['discs'].append(disc)
+                if psiso & 0x7fff:
+                    disc['errors'].append('PSISOIMG is not aligned to 0x8000')
+                if psiso < _end:
+                    disc['errors'].append('PSISOIMG overlaps the previous section')
+                d = pbp.disc(disc_num)
+                if d is None:
+                    disc['errors'].append('No PSISOIMG header')
+                    disc['ok'] = False
+                    errors.append('Disc %d is damaged' % disc_num)
+                    continue
+                length = d['length']
+                disc['length'] = length
+                _end = psiso + length
+                if _end > size:
+                    disc['errors'].append('PSISOIMG is past the end of the file')
+                if d['length_1220'] != length + 0x2d31:
+                    disc['errors'].append('Length at 0x1220 does not match the PSISOIMG length')
+
+                # check the index table
+                entries = len(d['index'])
+                payload_end = 0
+                for _off, _len, digest in d['index']:
+                    payload_end = max(payload_end, _off + _len - psiso)
+                if payload_end > length:
+                    disc['errors'].append('Blocks extend past the end of the PSISOIMG')
+
+                # check all the blocks
+                blocks = 0
+                bad = []
+                for block, err in ordered_map(self.check_block,
+                                              pbp.payloads(disc_num),
+                                              self._threads):
+                    blocks = blocks + 1
+                    if err:
+                        bad.append({'block': block, 'error': err})
+                if blocks < entries:
+                    disc['errors'].append('%d blocks are missing from the end of the file' % (entries - blocks))
+                disc['blocks'] = blocks
+                disc['bad_blocks'] = len(bad)
+                # do not let a badly broken image make the report huge
+                disc['errors'] = disc['errors'] + ['Block %d: %s' % (b['block'], b['error']) for b in bad[:100]]
+
+                # audio tracks table
+                _tend = payload_end
+                for i, (_off, _len) in enumerate(d['tracks']):
+                    if _off - psiso < _tend:
+                        disc['errors'].append('Audio track %d overlaps the blocks or the previous track' % (i + 2))
+                    _tend = _off - psiso + _len
+                    if _tend > length:
+                        disc['errors'].append('Audio track %d extends past the end of the PSISOIMG' % (i + 2))
+                disc['tracks'] = len(d['tracks'])
+                disc['ok'] = not disc['errors']
+                if disc['errors']:
+                    errors.append('Disc %d is damaged' % disc_num)
+
+            # STARTDAT follows the last disc
+            startdat = pbp.startdat
+            if startdat is None:
+                startdat = (_end + 0xf) & 0xfffffff0
+            report['startdat'] = startdat
+            buf = pbp.pread(startdat, 0x50)
+            if buf[:8] != b'STARTDAT':
+                errors.append('No STARTDAT at 0x%08x' % startdat)
+            elif startdat < _end:
+                errors.append('STARTDAT overlaps the last disc')
+            else:
+                _hlen, _llen = struct.unpack_from('<II', buf, 16)
+                if pbp.pread(startdat + _hlen + _llen, 4) != b'\x00PGD':
+                    errors.append('No PGD after the STARTDAT logo')
+
+        report['ok'] = not errors
+        return report
+
+    # dat is either a PSISO%d.DAT file or the EBOOT.PBP itself
+    def dump_to_img(self, dat, img, cue, toc, offset=0):
         def dcb(i):
             return ((i & 0xf0) >> 4) * 10 + (i & 0x0f)
         def msf_to_sect(m, s, f):
@@ -2674,7 +3444,7 @@ class popstation(object):
         with open(dat, 'rb') as i:
             print('Create', toc) if self._verbose else None
             with open(toc, 'wb') as o:
-                i.seek(0x800)
+                i.seek(offset + 0x800)
                 buf = i.read(1020)
                 o.write(buf)
                 _i = 1
@@ -2697,21 +3467,9 @@ class popstation(object):
 
             print('Create', img) if self._verbose else None
             with open(img, 'wb') as o:
-                _o = 0x4000
-                while True:
-                    i.seek(_o)
-                    buf = i.read(32)
-                    _off = struct.unpack_from('<I', buf, 0)[0]
-                    _len = struct.unpack_from('<H', buf, 4)[0]
-                    _o = _o + 32
-                    if _len == 0:
-                        break
-                    i.seek(0x100000 + _off)
-                    buf = i.read(_len)
-                    if not buf:
-                        break
-                    if len(buf) < 0x9300:
-                        buf = zlib.decompress(buf, wbits=-15)
+                for buf in ordered_map(self.inflate_block,
+                                       self.read_payloads(i, offset),
+                                       self._threads):
                     o.write(buf)
                 print('Dumped', img, 'size', o.tell())
                 try:
@@ -2780,11 +3538,98 @@ class popstation(object):
         toc[27] = bcd(mins)
         return toc
 
-    def encode_psiso(self, fh, disc_num, img_toc):
-        def bcd(i):
-            return int(i % 10) + 16 * (int(i / 10) % 10)
+    # The blocks are memoryviews into the readahead chunks. (index of the last
+    # block, chunk) is added to chunks so the caller knows when to release it.
+    def read_blocks(self, reader, chunks):
+        i = 0
+        pos = 0
+        for chunk, n in reader.chunks():
+            chunks.append((i + int((n + 0x9300 - 1) / 0x9300) - 1, chunk))
+            for o in range(0, n, 0x9300):
+                if n - o < 0x9300:
+                    chunk[n:o + 0x9300] = bytes(o + 0x9300 - n)
+                pos = pos + min(n - o, 0x9300)
+                buf = memoryview(chunk)[o:o + 0x9300]
+                if self._hotfixes and pos < 1048576:
+                    buf = bytearray(buf)
+                    for fix in self._hotfixes:
+                        buf = buf.replace(fix[0], fix[1])
+                i = i + 1
+                yield buf
 
-        att = bytes(0)
+    # raw deflate, without the zlib header and checksum
+    def deflate(self, buf):
+        return self._backend.compress(buf, self._complevel)
+
+    # zero filled and padding blocks are very common so we only compress
+    # them once
+    def constant_block(self, fill):
+        k = (fill, self._complevel, self._backend.name if self._backend else None)
+        if k not in self._constant_blocks:
+            buf = bytes([fill]) * 0x9300
+            c = buf
+            if self._complevel != 0:
+                c = self.deflate(buf)
+            self._constant_blocks[k] = (c, hashlib.sha1(buf).digest())
+        return self._constant_blocks[k]
+
+    # If none of a few small samples shrinks the whole block will not either.
+    # This catches XA audio and FMV sectors.
+    def incompressible(self, buf):
+        for o in (0, 0x4980, 0x9300 - 0x800):
+            z = zlib.compressobj(1, zlib.DEFLATED, -15)
+            if len(z.compress(buf[o:o + 0x800]) + z.flush()) < 0x800 * 0.98:
+                return False
+        return True
+
+    # Runs in the worker threads. In dedup mode a block that is the same as
+    # an earlier one is not compressed again.
+    def compress_block(self, buf, index=None, dedup_blocks=None):
+        # cheap check on the first bytes before we scan the whole block
+        _b = bytes(buf[:64])
+        if _b.count(_b[0]) == 64 and bytes(buf) == _b[:1] * 0x9300:
+            c, digest = self.constant_block(buf[0])
+            return buf, c if len(c) < 0x9300 else buf, digest, 'constant'
+
+        digest = hashlib.sha1(buf).digest()
+        if dedup_blocks is not None and index is not None:
+            # The blocks are committed in order so if an earlier block has
+            # the same contents its payload will already be in the file
+            # by the time we commit this one. setdefault() is atomic.
+            if dedup_blocks.setdefault(digest, index) < index:
+                return buf, b'', digest, 'duplicate'
+        if self._complevel == 0:
+            return buf, buf, digest, 'stored'
+
+        if self._block_cache:
+            c = self._block_cache.get(digest, self._complevel, self._backend.name)
+            if c is not None:
+                # an empty entry means the block does not compress
+                return buf, c if len(c) else buf, digest, 'cached'
+
+        if self._skip_incompressible:
+            t = time.thread_time()
+            skip = self.incompressible(buf)
+            self.count('probe_time', time.thread_time() - t)
+            if skip:
+                return buf, buf, digest, 'skipped'
+
+        t = time.thread_time()
+        if self._archive:
+            # the archive backend also tells us how big the level 1 block
+            # would have been
+            c, default_len = self._backend.compress_archive(buf)
+            self.count('archive_saved', min(default_len, 0x9300) - min(len(c), 0x9300))
+        else:
+            c = self.deflate(buf)
+        self.count('deflate_time', time.thread_time() - t)
+        self.count('deflated')
+        if self._block_cache:
+            self._block_cache.put(digest, self._complevel, self._backend.name,
+                                  c if len(c) < 0x9300 else b'')
+        return buf, c, digest, 'compressed'
+
+    def psiso_size(self, disc_num, img_toc):
         with open(img_toc[0], 'rb') as f:
             f.seek(0, 2)
             isosize = f.tell()
@@ -2792,17 +3637,19 @@ class popstation(object):
             isosize = self._track0_size[disc_num]
         if isosize % 0x9300:
             isosize = isosize + (0x9300 - (isosize%0x9300))
+        return isosize
 
-        psiso_offset = fh.tell()
+    # The index table, the lengths and the audio tracks are filled in by
+    # psiso_trailer()
+    def psiso_header(self, disc_num, img_toc, isosize):
+        header = bytearray(0x100000)
 
         # Block #1
-        buf = bytearray(1024)
-        buf[:12] = b'PSISOIMG0000'
-        struct.pack_into('<I', buf, 12, isosize + 0x100000)
-        fh.write(buf)
-        
+        header[:12] = b'PSISOIMG0000'
+        struct.pack_into('<I', header, 12, isosize + 0x100000)
+
         # Block #2
-        buf = bytearray(1024)
+        buf = memoryview(header)[0x400:0x800]
         gid = self._disc_ids[disc_num]
         buf[0:11] = bytes('_' + gid[0:4] + '_' + gid[4:9], encoding='utf-8')
         if self._configs and self._configs[disc_num]:
@@ -2815,146 +3662,379 @@ class popstation(object):
                     # PS3
                     buf[0x24:0x24 + 8] = bytes([0x00, 0x00, 0x20, 0x00, 0x00, 0x00, 0x00, 0x00])
                     buf[0x2c:0x2c + _l] = self._configs[disc_num]
-        fh.write(buf)
 
         # Block #3
-        buf = bytearray(1024)
+        buf = memoryview(header)[0x800:0xc00]
         toc = self.get_toc(img_toc, isosize)
         buf[:len(toc)] = toc
         # disc start offset == 0x100000
-        struct.pack_into('<I', buf, 0x3fc, 0x100000) 
-        fh.write(buf)
+        struct.pack_into('<I', buf, 0x3fc, 0x100000)
 
         # Block #4
-        # audio tracks table
-        _b = bytearray(1568)
-        att_offset = fh.tell()
-        fh.write(_b)
+        # audio tracks table at 0xc00, filled in by psiso_trailer()
 
         # block #5
-        p2_offset = fh.tell()
-        buf = bytearray(480)
+        buf = memoryview(header)[0x1220:0x1400]
         buf[8:10] = b'\xff\x07'
         b = bytes(self._game_title, encoding='utf-8')
         buf[12:12 + len(b)] = b
         # where the magic word is stored
         if disc_num < len(self._magic_word):
             print('Injecting MAGIC WORD 0x%08x for disc %d' % (self._magic_word[disc_num], disc_num))
-            struct.pack_into('<I', buf, 144, self._magic_word[disc_num]) 
-
-        fh.write(buf)
+            struct.pack_into('<I', buf, 144, self._magic_word[disc_num])
 
-        # Blocks 6 - 16
-        fh.write(bytes(11264))
-
-        print('Writing indexes') if self._verbose else None
-        index_offset = fh.tell()
-        for i in range(int(isosize / 0x9300)):
-            b = bytearray(32)
-            fh.write(b)
+        # Blocks 6 - 16 are empty and the index table starts at 0x4000
 
         # insert the subchannel blob
         if disc_num < len(self._subchannels) and self._subchannels[disc_num]:
-            x = fh.tell()
-            _b = bytearray(8)
+            x = 0x4000 + int(isosize / 0x9300) * 32
             sc_len = len(self._subchannels[disc_num])
-            print('Injecting subchannel blob of len %d at offset 0x%08x for disc %d' % (sc_len, fh.tell(), disc_num))
-            struct.pack_into('<I', _b, 0, fh.tell() - psiso_offset)
-            struct.pack_into('<I', _b, 4, int(sc_len / 12))
-            fh.seek(psiso_offset + 0x12d4)
-            fh.write(_b)
+            print('Injecting subchannel blob of len %d at offset 0x%08x for disc %d' % (sc_len, x, disc_num))
+            struct.pack_into('<I', header, 0x12d4, x)
+            struct.pack_into('<I', header, 0x12d8, int(sc_len / 12))
+            header[x:x + sc_len] = self._subchannels[disc_num]
 
-            fh.seek(x)
-            fh.write(self._subchannels[disc_num])
-            
-        offset = fh.tell()
-        fh.write(bytes(psiso_offset + 0x100000 - offset))
+        return header
 
-        print('Writing PSX CD Dump') if self._verbose else None
-        fi = open(img_toc[0], 'rb')
-        indexes = bytearray(0)
-        print('Writing compressed image') if self._verbose else None
-        offset = 0
-        i = 0
+    # Returns the length of the PSISOIMG and (offset, file) for the ATRAC3
+    # tracks to append after the blocks
+    def psiso_trailer(self, disc_num, header, indexes, size):
+        header[0x4000:0x4000 + len(indexes)] = indexes
 
-        while True:
-            if fi.tell() >= isosize:
-                break
-            buf = fi.read(0x9300)
-            if not buf:
-                break
-            if len(buf) < 0x9300:
-                buf = buf + bytearray(0x9300 - len(buf))
-            if self._hotfixes and fi.tell() < 1048576:
-                for fix in self._hotfixes:
-                    buf = buf.replace(fix[0], fix[1])
-            c = buf
-            if self._complevel != 0:
-                c = zlib.compress(buf, self._complevel)
-                c = c[2:-4]
-            idx = bytearray(32)
-            struct.pack_into('<I', idx, 0, offset)
-            h = hashlib.sha1()
-            h.update(buf)
-            if self._complevel == 0:
-                idx[6] = 0x01 # we need this for uncompressed image in ps3 pkg?
-            idx[8:24] = h.digest()[:16]
-            if len(c) >= 0x9300:
-                struct.pack_into('<H', idx, 4, 0x9300)
-                fh.write(buf)
-                offset = offset + 0x9300
-            if len(c) < 0x9300:
-                struct.pack_into('<H', idx, 4, len(c))
-                fh.write(c)
-                offset = offset + len(c)
-            indexes = indexes + idx
-            i = i + 1
-
-        # insert the aa3 blobs
+        # the aa3 blobs go after the blocks
+        pos = 0x100000 + size
+        aea = []
+        att = bytes(0)
         if disc_num < len(self._aea):
-            fh.seek((fh.tell() + 0xf) & 0xfffffff0)
+            pos = (pos + 0xf) & 0xfffffff0
             for i in self._aea[disc_num]:
-                print('Inject', i, 'at %08x' % fh.tell())
-                with open(i, 'rb') as f:
-                    f.seek(0x60)
-                    buf = f.read()
-                    _b = bytearray(16)
-                    struct.pack_into('<I', _b, 0, fh.tell() - psiso_offset - 0x100000)
-                    struct.pack_into('<I', _b, 4, len(buf))
-                    att = att + _b
-                    print('Write AEA at 0x%08x' % fh.tell()) if self._verbose else None
-                    fh.write(buf)
-
-        
-        if fh.tell() & 0xf:
-            fh.seek((fh.tell() + 0xf) & 0xfffffff0)
-        end_offset = fh.tell() - psiso_offset
-        x = fh.tell()
-        fh.seek(index_offset)
-        fh.write(indexes)
+                _l = max(os.stat(i).st_size - 0x60, 0)
+                _b = bytearray(16)
+                struct.pack_into('<I', _b, 0, pos - 0x100000)
+                struct.pack_into('<I', _b, 4, _l)
+                att = att + _b
+                aea.append((pos, i))
+                pos = pos + _l
+        end_offset = (pos + 0xf) & 0xfffffff0
 
         # update PSISOIMG0000xxxx length
-        buf = bytearray(4)
-        fh.seek(psiso_offset + 12)
-        struct.pack_into('<I', buf, 0, end_offset)
-        fh.write(buf)
-
-        end_offset = end_offset + 0x2d31
-
+        struct.pack_into('<I', header, 12, end_offset)
         # update the length at offset 0x1220
-        fh.seek(p2_offset)
-        buf = bytearray(4)
-        struct.pack_into('<I', buf, 0, end_offset)
-        fh.write(buf)
-        
+        struct.pack_into('<I', header, 0x1220, end_offset + 0x2d31)
         if len(att):
-            fh.seek(att_offset)
-            fh.write(att)
+            header[0xc00:0xc00 + len(att)] = att
+
+        return end_offset, aea
+
+    def write_aea(self, fh, psiso_offset, aea):
+        for _o, i in aea:
+            # aligned to 16 bytes
+            if fh.tell() < psiso_offset + _o:
+                fh.write(bytes(psiso_offset + _o - fh.tell()))
+            print('Inject', i, 'at %08x' % fh.tell())
+            with open(i, 'rb') as f:
+                f.seek(0x60)
+                print('Write AEA at 0x%08x' % fh.tell()) if self._verbose else None
+                fh.write(f.read())
+
+    def select_backend(self):
+        if self._complevel != 0:
+            self._backend = self._deflate_backend
+            if self._archive:
+                self._backend = archive_backend()
+            if not self._backend:
+                self._backend = get_backend('zlib')
+            if self._complevel not in self._backend.levels:
+                raise Exception('Deflate backend %s does not support level %d' % (self._backend.name, self._complevel))
+        return self._backend
+
+    # everything that affects the compressed blocks of an image
+    def payload_key(self, img_toc, isosize):
+        st = os.stat(img_toc[0])
+        return (os.path.abspath(img_toc[0]), st.st_size, st.st_mtime_ns,
+                isosize, self._complevel,
+                self._backend.name if self._complevel else None,
+                self._skip_incompressible, self._dedup,
+                tuple(self._hotfixes) if self._hotfixes else None)
+
+    def copy_payload(self, fh, shared, indexes):
+        path, offset, size, _indexes = shared
+        print('Copying %d bytes of compressed blocks from %s' % (size, path)) if self._verbose else None
+        indexes[:] = _indexes
+        # path can be the file we are writing, make sure everything we
+        # wrote to it is there before we read it back
+        fh.flush()
+        with open(path, 'rb') as f:
+            copy_range(f, offset, size, fh, self._chunk_size)
+        return size
+
+    # compress_image() for complevel 0. Hotfixes only apply to the first 1MB,
+    # the rest of the image is copied with copy_range().
+    def store_image(self, disc_num, img_toc, isosize, indexes, fh=None):
+        fi = open(img_toc[0], 'rb')
+        reader = None
+        results = None
+        try:
+            fi.seek(0, 2)
+            realsize = min(fi.tell(), isosize)
+            fi.seek(0)
+            depth = self._threads * 4
+            reader = readahead(fi, isosize, self._chunk_size, self._queue_depth,
+                               inflight=depth + 1)
+            chunks = collections.deque()
+            blocks = self.read_blocks(reader, chunks)
+            # the blocks that read_blocks() has applied the hotfixes to
+            head = bytearray()
+            i = -1
+            results = ordered_map(lambda b: (b, hashlib.sha1(b).digest()),
+                                  blocks,
+                                  self._threads,
+                                  depth=depth,
+                                  pool=self._pool)
+            for i, (buf, digest) in enumerate(results):
+                _o = i * 32
+                struct.pack_into('<IH', indexes, _o, i * 0x9300, 0x9300)
+                indexes[_o + 6] = 0x01 # we need this for uncompressed image in ps3 pkg?
+                indexes[_o + 8:_o + 24] = digest[:16]
+                if isinstance(buf, bytearray):
+                    head += buf
+                if len(chunks) and chunks[0][0] == i:
+                    reader.release(chunks.popleft()[1])
+            results.close()
+            results = None
+            reader.close()
+            reader = None
+            if fh:
+                print('Copying image') if self._verbose else None
+                fh.write(head)
+                n = max(realsize - len(head), 0)
+                copy_range(fi, len(head), n, fh, self._chunk_size)
+                fh.write(bytes(isosize - len(head) - n))
+        finally:
+            if results is not None:
+                results.close()
+            if reader:
+                reader.close()
+            fi.close()
+        if fh:
+            self.count('stored', i + 1)
+            print('Disc %d: %d blocks' % (disc_num, i + 1)) if self._verbose else None
+        return isosize
+
+    # If fh is None we only work out where the blocks would end up.
+    # Returns the total size of the blocks.
+    def compress_image(self, disc_num, img_toc, isosize, indexes, fh=None):
+        if self._complevel == 0 and not self._dedup and \
+           all(len(fix[0]) == len(fix[1]) for fix in self._hotfixes or []):
+            return self.store_image(disc_num, img_toc, isosize, indexes, fh)
+        if self.select_backend():
+            print('Using deflate backend', self._backend.name) if self._verbose else None
+
+        fi = open(img_toc[0], 'rb')
+        offset = 0
+
+        reader = None
+        writer = None
+        results = None
+        # make sure the threads and the image are released whatever goes
+        # wrong, the GUIs keep running after a failed build
+        try:
+            # The image is read in large chunks by the readahead thread,
+            # compressed and hashed in the worker threads, committed in order
+            # here and then written in large chunks by the writebehind thread.
+            depth = self._threads * 4
+            reader = readahead(fi, isosize, self._chunk_size, self._queue_depth,
+                               inflight=depth + 1)
+            if fh:
+                writer = writebehind(fh, self._chunk_size, self._queue_depth)
+            chunks = collections.deque()
+            blocks = self.read_blocks(reader, chunks)
+            archive_saved = self._stats['archive_saved']
+            probe_time = self._stats['probe_time']
+            stats = collections.Counter()
+            # SHA1 of the block -> (offset, length) of its payload
+            payloads = {}
+            dedup_saved = 0
+            dedup_blocks = {} if self._dedup else None
+            results = ordered_map(lambda b: self.compress_block(b[1], b[0], dedup_blocks),
+                                  enumerate(blocks),
+                                  self._threads,
+                                  depth=depth,
+                                  pool=self._pool)
+            for i, (buf, c, digest, how) in enumerate(results):
+                _o = i * 32
+                if self._dedup and digest in payloads:
+                    # point at the payload of the earlier block
+                    _off, _len = payloads[digest]
+                    how = 'duplicate'
+                    dedup_saved = dedup_saved + _len
+                else:
+                    if len(c) >= 0x9300:
+                        c = buf
+                    _off, _len = offset, len(c)
+                    if self._dedup:
+                        payloads[digest] = (_off, _len)
+                    if writer:
+                        writer.write(c)
+                    offset = offset + len(c)
+                struct.pack_into('<IH', indexes, _o, _off, _len)
+                if self._complevel == 0:
+                    indexes[_o + 6] = 0x01 # we need this for uncompressed image in ps3 pkg?
+                indexes[_o + 8:_o + 24] = digest[:16]
+                stats[how] = stats[how] + 1
+                # all blocks of the oldest chunk are done so we can reuse it
+                if len(chunks) and chunks[0][0] == i:
+                    reader.release(chunks.popleft()[1])
+            if writer:
+                w, writer = writer, None
+                w.close()
+        finally:
+            if results is not None:
+                results.close()
+            if writer:
+                writer.abort()
+            if reader:
+                reader.close()
+            fi.close()
+        if not fh:
+            return offset
 
+        with self._stats_lock:
+            self._stats.update(stats)
+        print('Disc %d: %d blocks, %d constant blocks' % (disc_num, sum(stats.values()), stats['constant'])) if self._verbose else None
+        if self._skip_incompressible:
+            # estimate what the skipped blocks would have cost from the
+            # average time it took to compress the other blocks. The probes
+            # are reported on their own so the estimate is never negative.
+            _avg = self._stats['deflate_time'] / max(self._stats['deflated'], 1)
+            print('Disc %d: skipped compression of %d incompressible blocks, saving about %.2f seconds of compression, probing took %.2f seconds of CPU time' % (disc_num, stats['skipped'], stats['skipped'] * _avg, self._stats['probe_time'] - probe_time))
+        if self._dedup:
+            self.count('dedup_saved', dedup_saved)
+            print('Disc %d: %d duplicate blocks, deduplication saved %d bytes' % (disc_num, stats['duplicate'], dedup_saved))
+        if self._archive:
+            print('Disc %d: archive compression saved %d bytes compared to level 1' % (disc_num, self._stats['archive_saved'] - archive_saved))
+        if self._block_cache:
+            self._block_cache.flush()
+            print('Block cache hits: %d misses: %d' % (self._block_cache.hits, self._block_cache.misses)) if self._verbose else None
+        return offset
+
+    # Work out the header and the lengths without writing anything so that
+    # stream_psiso() can write the PSISOIMG in one pass
+    def plan_psiso(self, disc_num, img_toc):
+        isosize = self.psiso_size(disc_num, img_toc)
+        header = self.psiso_header(disc_num, img_toc, isosize)
+        indexes = bytearray(int(isosize / 0x9300) * 32)
+        print('Planning layout for disc %d' % disc_num) if self._verbose else None
+        # the blocks are compressed again by stream_psiso() so only that
+        # pass goes into the stats
+        with self._stats_lock:
+            stats = self._stats.copy()
+        size = self.compress_image(disc_num, img_toc, isosize, indexes)
+        with self._stats_lock:
+            self._stats = stats
+        end_offset, aea = self.psiso_trailer(disc_num, header, indexes, size)
+        return header, end_offset, aea
+
+    # The blocks are compressed a second time. Compression is deterministic
+    # so they come out the same as in plan_psiso().
+    def stream_psiso(self, fh, disc_num, img_toc, plan):
+        header, end_offset, aea = plan
+        isosize = self.psiso_size(disc_num, img_toc)
+        psiso_offset = fh.tell()
+        fh.write(header)
+        print('Writing compressed image') if self._verbose else None
+        indexes = bytearray(int(isosize / 0x9300) * 32)
+        self.compress_image(disc_num, img_toc, isosize, indexes, fh)
+        if indexes != header[0x4000:0x4000 + len(indexes)]:
+            raise Exception('Disc %d changed while we were writing it' % disc_num)
+        self.write_aea(fh, psiso_offset, aea)
+        fh.write(bytes(psiso_offset + end_offset - fh.tell()))
+
+    def encode_psiso(self, fh, disc_num, img_toc, share=True):
+        isosize = self.psiso_size(disc_num, img_toc)
+        psiso_offset = fh.tell()
+
+        print('Writing indexes') if self._verbose else None
+        header = self.psiso_header(disc_num, img_toc, isosize)
+        indexes = bytearray(int(isosize / 0x9300) * 32)
+        fh.write(header)
+
+        print('Writing PSX CD Dump') if self._verbose else None
+        print('Writing compressed image') if self._verbose else None
+        shared = None
+        if self._shared is not None:
+            self.select_backend()
+            key = self.payload_key(img_toc, isosize)
+            shared = self._shared.get(key)
+        if shared:
+            size = self.copy_payload(fh, shared, indexes)
+        elif share and self._shared is not None and self._shared.work_dir:
+            # compress into the work dir and copy from there, the other
+            # EBOOTs copy from the same file
+            with self._shared.new_file() as f:
+                size = self.compress_image(disc_num, img_toc, isosize, indexes, f)
+                f.flush()
+                copy_range(f, 0, size, fh, self._chunk_size)
+            self._shared.put(key, os.path.abspath(f.name), 0, size, indexes)
+        else:
+            size = self.compress_image(disc_num, img_toc, isosize, indexes, fh)
+            if share and self._shared is not None and isinstance(getattr(fh, 'name', None), str):
+                self._shared.put(key, os.path.abspath(fh.name), psiso_offset + 0x100000, size, indexes)
+
+        end_offset, aea = self.psiso_trailer(disc_num, header, indexes, size)
+        self.write_aea(fh, psiso_offset, aea)
+
+        # now that we have the index table and the lengths we can update
+        # the header
+        x = psiso_offset + end_offset
+        fh.seek(psiso_offset)
+        fh.write(header)
         fh.seek(x)
+        return header
+
+    # Encode every disc at the same time, each into its own temporary file.
+    # Returns a list of (temporary file, header).
+    def encode_discs(self, tmpdir=None):
+        def encode(disc_num, img_toc):
+            if self._shared is not None and self._shared.work_dir:
+                # create_pbp() shares the blocks from this file
+                f = self._shared.new_file()
+            else:
+                f = tempfile.TemporaryFile(dir=tmpdir)
+            try:
+                return f, self.encode_psiso(f, disc_num, img_toc, share=False)
+            except:
+                f.close()
+                raise
+
+        print('Encoding %d discs in parallel' % len(self._img_toc)) if self._verbose else None
+        # Every disc gets its own reader but they all submit their blocks
+        # to one pool of compression workers so we never run more than
+        # threads of them.
+        if self._threads > 1:
+            self._pool = ThreadPoolExecutor(max_workers=self._threads)
+        try:
+            with ThreadPoolExecutor(max_workers=len(self._img_toc)) as e:
+                futures = [e.submit(encode, disc_num, img_toc)
+                           for disc_num, img_toc in enumerate(self._img_toc)]
+        finally:
+            if self._pool:
+                self._pool.shutdown()
+                self._pool = None
+        encoded = []
+        error = None
+        for f in futures:
+            try:
+                encoded.append(f.result())
+            except Exception as ex:
+                error = error or ex
+        if error:
+            for f, header in encoded:
+                f.close()
+            raise error
+        return encoded
 
 
-            
     def dump_pbp(self, eboot):
         with open(eboot, 'rb') as e:
             # read header
@@ -3071,9 +4151,11 @@ class popstation(object):
                         _dso.append(_off + offset)
                     continue
                 if buf[:12] == b'PSISOIMG0000':
-                    # Iterate over the index table until we find the end
-                    # the last entry will tell us the end of the PSISO blob
-                    _o = offset + 0x4400
+                    # Iterate over the index table until we find the end.
+                    # Deduplicated blocks can point back at earlier
+                    # payloads so the end of the PSISO blob is the end of
+                    # the payload that is furthest in.
+                    _o = offset + 0x4000
                     _last_offset = 0
                     while True:
                         e.seek(_o)
@@ -3081,21 +4163,24 @@ class popstation(object):
                         buf = e.read(32)
                         _off = struct.unpack_from('<I', buf, 0)[0]
                         _len = struct.unpack_from('<H', buf, 4)[0]
-                        if _off == 0:
+                        if _len == 0:
                             break
-                        _last_offset = _off + _len
+                        _last_offset = max(_last_offset, _off + _len)
 
-                    print('Dumping PSISO%d.DAT' % _disc_id) if self._verbose else None
-                    e.seek(offset)
-                    with open('PSISO%d.DAT' % _disc_id, 'wb') as f: 
-                        _num = _last_offset + 0x100000
-                        while True:
-                           buf = e.read(1048576 if _num > 1048576 else _num)
-                           if not buf:
-                               break
-                           f.write(buf)
-                           _num = _num - len(buf)
-                    self.dump_to_img('PSISO%d.DAT' % _disc_id, 'PSISO%d.img' % _disc_id, 'PSISO%d.cue' % _disc_id, 'PSISO%d.toc' % _disc_id)
+                    if self._dump_psiso_dat:
+                        print('Dumping PSISO%d.DAT' % _disc_id) if self._verbose else None
+                        e.seek(offset)
+                        with open('PSISO%d.DAT' % _disc_id, 'wb') as f: 
+                            _num = _last_offset + 0x100000
+                            while True:
+                               buf = e.read(1048576 if _num > 1048576 else _num)
+                               if not buf:
+                                   break
+                               f.write(buf)
+                               _num = _num - len(buf)
+                    # decompress straight from the EBOOT.PBP
+                    self.dump_to_img(eboot, 'PSISO%d.img' % _disc_id, 'PSISO%d.cue' % _disc_id, 'PSISO%d.toc' % _disc_id, offset=offset)
+                    e.seek(offset + 0x100000 + _last_offset)
 
                     # pad to 16 bytes
                     if e.tell() & 0xf:
@@ -3157,59 +4242,142 @@ class popstation(object):
         print('Done dumping', eboot) if self._verbose else None
 
 
-    def create_iso_bin_dat(self, fh, pstitle, psiso_offsets):
-        print('Create ISO.BIN.DAT', self._iso_bin_dat)
-        with open(self._iso_bin_dat, 'wb') as _ibd:
-            _ibd.seek(len(pstitle))
-            for i in range(len(psiso_offsets)):
-                fh.seek(psiso_offsets[i])
-                _b = bytearray(fh.read(0x100000))
-                _b[12:16] = b'\x00\x00\x00\x00'
-                _ibd.write(_b)
-
-                _b = bytearray(4)
-                struct.pack_into('<I', _b, 0, psiso_offsets[i] + 0x100000 - 0x010000)
-                _ibd.seek(i * 0x100000 + 0xffc)
-                _ibd.write(_b)
-
-                _ibd.seek((i + 1) * 0x100000 + 0x3ff)
-                _ibd.write(bytes(1))
-
-            # fixup the header.
-            # See https://www.psdevwiki.com/ps3/Iso.bin.edat
-            _b = bytearray(1024)
-            _b[:16] = pstitle[:16]
-            _b[0x0264:0x0264 + 16] = pstitle[0x0264:0x0264 + 16]
-            for i in range(len(psiso_offsets)):
-                struct.pack_into('<I', _b, 0x0200 + i * 4, i * 0x100000 + 0x0400)
-            _ibd.seek(0)
+    # Replace PARAM.SFO and the images and sound without touching the discs.
+    # None keeps what is there and b'' removes it. DATA.PSAR is only moved if
+    # allow_move is set. Never do that for a PS3 package, ISO.BIN.EDAT has the
+    # absolute offsets of the discs.
+    def update_pbp(self, eboot, sfo=None, icon0=None, icon1=None, pic0=None, pic1=None, snd0=None, allow_move=False):
+        names = ['sfo', 'icon0', 'icon1', 'pic0', 'pic1', 'snd0', 'datapsp', 'datapsar']
+        new = {'sfo': sfo, 'icon0': icon0, 'icon1': icon1, 'pic0': pic0,
+               'pic1': pic1, 'snd0': snd0}
+        with open(eboot, 'rb') as e:
+            buf = e.read(0x28)
+            if buf[0:4] != b'\x00PBP':
+                raise Exception('Not a PBP file')
+            offsets = struct.unpack_from('<8I', buf, 8)
+            # the files between the header and DATA.PSAR
+            files = []
+            for i in range(7):
+                if names[i] in new and new[names[i]] is not None:
+                    files.append(new[names[i]])
+                    continue
+                e.seek(offsets[i])
+                files.append(e.read(offsets[i + 1] - offsets[i]))
+            # DATA.PSP runs up to DATA.PSAR including the padding. We pad
+            # with zeros again when we write it so we can drop them.
+            files[6] = files[6].rstrip(b'\x00')
+            e.seek(0, 2)
+            psar = offsets[7]
+            psar_size = e.tell() - psar
+
+        header = bytearray(buf)
+        curoffs = 0x28
+        for i in range(7):
+            struct.pack_into('<I', header, 8 + i * 4, curoffs)
+            curoffs = curoffs + len(files[i])
+
+        if curoffs <= psar:
+            print('Updating', eboot, 'in place') if self._verbose else None
+            struct.pack_into('<I', header, PSAR_OFFSET, psar)
+            with open(eboot, 'r+b') as fh:
+                fh.write(header + b''.join(files) + bytes(psar - curoffs))
+            return
+
+        # DATA.PSAR has to move to make room
+        if not allow_move:
+            raise Exception('The new files need 0x%08x bytes but DATA.PSAR starts at 0x%08x in %s' % (curoffs, psar, eboot))
+        x = (curoffs + 0xffff) & 0xffff0000
+        struct.pack_into('<I', header, PSAR_OFFSET, x)
+        print('Moving DATA.PSAR in', eboot, 'from 0x%08x to 0x%08x' % (psar, x)) if self._verbose else None
+        tmp = eboot + '.tmp'
+        with open(eboot, 'rb') as e:
+            with open(tmp, 'wb+') as fh:
+                fh.write(header + b''.join(files) + bytes(x - curoffs))
+                copy_range(e, psar, psar_size, fh, self._chunk_size)
+        os.replace(tmp, eboot)
+
+    # iso_bin_dat is a file name or a file object, so the caller can sign
+    # and encrypt it in memory
+    def create_iso_bin_dat(self, pstitle, psiso_offsets, headers):
+        print('Create ISO.BIN.DAT', self._iso_bin_dat if isinstance(self._iso_bin_dat, str) else '')
+        _ibd = io.BytesIO()
+        _ibd.seek(len(pstitle))
+        for i in range(len(psiso_offsets)):
+            _b = bytearray(headers[i])
+            _b[12:16] = b'\x00\x00\x00\x00'
             _ibd.write(_b)
 
-            # Inject subchannel data
-            sc_offset = 0x100000 * len(self._subchannels) + 0x400
-            for idx in range(len(self._subchannels)):
-                if not self._subchannels[idx]:
-                    continue
-                print('Inject subchannel data for disk', idx)
-                _b = bytearray(8)
-                sc_len = len(self._subchannels[idx])
-                struct.pack_into('<I', _b, 0, sc_offset)
-                struct.pack_into('<I', _b, 4, int(sc_len/12))
-                _ibd.seek(0x100000 * idx + 0x400 + 0x12d4)
-                print('Write offset/count at 0x%08x' % _ibd.tell())
-                _ibd.write(_b)
+            _b = bytearray(4)
+            struct.pack_into('<I', _b, 0, psiso_offsets[i] + 0x100000 - 0x010000)
+            _ibd.seek(i * 0x100000 + 0xffc)
+            _ibd.write(_b)
+
+            _ibd.seek((i + 1) * 0x100000 + 0x3ff)
+            _ibd.write(bytes(1))
+
+        # fixup the header.
+        # See https://www.psdevwiki.com/ps3/Iso.bin.edat
+        _b = bytearray(1024)
+        _b[:16] = pstitle[:16]
+        _b[0x0264:0x0264 + 16] = pstitle[0x0264:0x0264 + 16]
+        for i in range(len(psiso_offsets)):
+            struct.pack_into('<I', _b, 0x0200 + i * 4, i * 0x100000 + 0x0400)
+        _ibd.seek(0)
+        _ibd.write(_b)
 
-                _ibd.seek(sc_offset)
-                _ibd.write(self._subchannels[idx])
+        # Inject subchannel data
+        sc_offset = 0x100000 * len(self._subchannels) + 0x400
+        for idx in range(len(self._subchannels)):
+            if not self._subchannels[idx]:
+                continue
+            print('Inject subchannel data for disk', idx)
+            _b = bytearray(8)
+            sc_len = len(self._subchannels[idx])
+            struct.pack_into('<I', _b, 0, sc_offset)
+            struct.pack_into('<I', _b, 4, int(sc_len/12))
+            _ibd.seek(0x100000 * idx + 0x400 + 0x12d4)
+            print('Write offset/count at 0x%08x' % _ibd.tell())
+            _ibd.write(_b)
+
+            _ibd.seek(sc_offset)
+            _ibd.write(self._subchannels[idx])
+
+            sc_offset = sc_offset + sc_len
+
+        # hash it as we write it so that it can be signed without reading
+        # it back
+        self._iso_bin_dat_sha1 = hashlib.sha1()
+        f = self._iso_bin_dat
+        if isinstance(f, str):
+            f = open(f, 'wb')
+        with _ibd.getbuffer() as _buf:
+            for o in range(0, len(_buf), self._chunk_size):
+                self._iso_bin_dat_sha1.update(_buf[o:o + self._chunk_size])
+                f.write(_buf[o:o + self._chunk_size])
+        if f is not self._iso_bin_dat:
+            f.close()
 
-                sc_offset = sc_offset + sc_len
 
+    # In stream mode fh only needs to support write()
+    def create_pbp(self, fh=None):
+        plans = []
+        if self._stream:
+            # Compress every disc once up front to work out the layout so
+            # that we can write the whole EBOOT.PBP in order, without
+            # seeking back to update the headers.
+            for disc_num, img_toc in enumerate(self._img_toc):
+                plans.append(self.plan_psiso(disc_num, img_toc))
 
-    def create_pbp(self):
         print('Generating PARAM.SFO [%s]...' % self._game_title) if self._verbose else None
         sfo = GenerateSFO(self._sfo)
 
-        fh = open(self._eboot, 'wb+')
+        _fh = fh
+        if not fh:
+            if self._shared is not None:
+                self._shared.forget(self._eboot)
+            fh = open(self._eboot, 'wb' if self._stream else 'wb+')
+        if self._stream:
+            fh = streamwriter(fh)
         
         #
         # Header and file table
@@ -3276,29 +4444,70 @@ class popstation(object):
             _pstitle = bytearray(_pstitledata)
 
             # skip past _pstitle, we will write it later
-            fh.seek(_psar_offset + len(_pstitle))
+            x = _psar_offset + len(_pstitle)
         else:
             # If there is no PSTITLEIMG then the PSISOIMG will be aligned
             # on the next 0x10000 boundary.
-            fh.seek( (fh.tell() + 0xffff) & 0xffff0000 )
+            x = (fh.tell() + 0xffff) & 0xffff0000
 
         disc_num = 0
         psiso_offsets = []
-        for img_toc in self._img_toc:
-            fh.seek((fh.tell() + 0x7fff) & 0xffff8000)
-            if not self._no_pstitleimg:
-                struct.pack_into('<I', _pstitle, 0x200 + disc_num * 4, fh.tell() - _psar_offset)
-            psiso_offsets.append(fh.tell())
-            self.encode_psiso(fh, disc_num, img_toc)
-            fh.seek(0, 2)
-            fh.seek((fh.tell() + 0xf) & 0xfffffff0)
-            disc_num = disc_num + 1
-                            
-        # Add padding before STARTDAT
-        fh.seek((fh.tell() + 0x0f) & 0xfffffff0)
-
-        x = fh.tell()
+        headers = []
+        if self._stream:
+            for header, end_offset, aea in plans:
+                x = (x + 0x7fff) & 0xffff8000
+                psiso_offsets.append(x)
+                headers.append(header)
+                x = (x + end_offset + 0xf) & 0xfffffff0
+        elif self._parallel_discs and len(self._img_toc) > 1:
+            tmpdir = self._temp_dir
+            if not tmpdir and not _fh:
+                # same file system as the EBOOT.PBP so copy_range() can
+                # share the blocks
+                tmpdir = os.path.dirname(os.path.abspath(self._eboot))
+            encoded = self.encode_discs(tmpdir)
+            try:
+                for disc_num, (f, header) in enumerate(encoded):
+                    x = (x + 0x7fff) & 0xffff8000
+                    psiso_offsets.append(x)
+                    headers.append(header)
+                    end_offset = struct.unpack_from('<I', header, 12)[0]
+                    print('Copying disc %d to 0x%08x' % (disc_num, x)) if self._verbose else None
+                    fh.seek(x)
+                    copy_range(f, 0, os.fstat(f.fileno()).st_size, fh, self._chunk_size)
+                    if self._shared is not None and \
+                       (self._shared.work_dir or isinstance(getattr(fh, 'name', None), str)):
+                        img_toc = self._img_toc[disc_num]
+                        isosize = self.psiso_size(disc_num, img_toc)
+                        indexes = header[0x4000:0x4000 + int(isosize / 0x9300) * 32]
+                        size = max([o + l for o, l in struct.iter_unpack('<IH26x', indexes)] + [0])
+                        if self._shared.work_dir:
+                            path, offset = f.name, 0x100000
+                        else:
+                            path, offset = fh.name, x + 0x100000
+                        self._shared.put(self.payload_key(img_toc, isosize),
+                                         os.path.abspath(path), offset, size, indexes)
+                    x = (x + end_offset + 0xf) & 0xfffffff0
+            finally:
+                for f, header in encoded:
+                    f.close()
+        else:
+            fh.seek(x)
+            for img_toc in self._img_toc:
+                fh.seek((fh.tell() + 0x7fff) & 0xffff8000)
+                psiso_offsets.append(fh.tell())
+                headers.append(self.encode_psiso(fh, disc_num, img_toc))
+                fh.seek(0, 2)
+                fh.seek((fh.tell() + 0xf) & 0xfffffff0)
+                disc_num = disc_num + 1
+
+            # Add padding before STARTDAT
+            fh.seek((fh.tell() + 0x0f) & 0xfffffff0)
+            x = fh.tell()
+
         if not self._no_pstitleimg:
+            for disc_num in range(len(psiso_offsets)):
+                struct.pack_into('<I', _pstitle, 0x200 + disc_num * 4, psiso_offsets[disc_num] - _psar_offset)
             # update PSTITLEIMG
             _pstitle[:16] = b'PSTITLEIMG000000'
             # update offset to STARTDAT
@@ -3311,13 +4520,22 @@ class popstation(object):
             _t = bytes(self._game_title, encoding='utf-8')
             _pstitle[0x30c:0x30c + len(_t)] = _t
             print('Writing PSTITLEIMG.DAT') if self._verbose else None
-            fh.seek(_psar_offset)
+            if self._stream:
+                fh.write(bytes(_psar_offset - fh.tell()))
+            else:
+                fh.seek(_psar_offset)
             fh.write(_pstitle)
 
             if self._iso_bin_dat:
-                self.create_iso_bin_dat(fh, _pstitle, psiso_offsets)
-            
-        fh.seek(x)
+                self.create_iso_bin_dat(_pstitle, psiso_offsets, headers)
+
+        if self._stream:
+            for disc_num, img_toc in enumerate(self._img_toc):
+                fh.write(bytes(psiso_offsets[disc_num] - fh.tell()))
+                self.stream_psiso(fh, disc_num, img_toc, plans[disc_num])
+            fh.write(bytes(x - fh.tell()))
+        else:
+            fh.seek(x)
 
         print('Writing STARTDAT header') if self._verbose else None
         struct.pack_into('<I', _startdatheader, 20, len(self._logo))
@@ -3326,7 +4544,12 @@ class popstation(object):
         fh.write(self._logo)
         print('Writing STARTDAT footer') if self._verbose else None
         fh.write(_startdatfooter)
-                
+        if self._stream:
+            fh.flush()
+            # close the pipe so that the reader sees the end of the file
+            if not _fh:
+                fh.close()
+
         print('EBOOT.PBP Created') if self._verbose else None
 
     def encode_vcd(self, fh, img_toc):
@@ -3357,21 +4580,29 @@ class popstation(object):
 
         fh.seek(0x100000)
         with open(img_toc[0], 'rb') as f:
-            while True:
-                buf = f.read(0x9300)
-                if not buf:
-                    break
-                fh.write(buf)
+            copy_range(f, 0, realisosize, fh, self._chunk_size)
 
-        print(self._vcd, 'Created') if self._verbose else None
+        print(getattr(fh, 'name', self._vcd), 'Created') if self._verbose else None
 
+    def write_vcd(self, img_toc, vcd):
+        print('Create VCD', vcd) if self._verbose else None
+        with open(vcd, 'wb') as fh:
+            self.encode_vcd(fh, img_toc)
+            if self._fsync:
+                fh.flush()
+                os.fsync(fh.fileno())
 
     def create_vcd(self):
-        print('Create VCD', self._vcd) if self._verbose else None
-        fh = open(self._vcd, 'wb')
-        self.encode_vcd(fh, self._img_toc[0])
+        self.write_vcd(self._img_toc[0], self._vcd)
         self._img_toc = []
 
+    # vcds is a list of (img_toc, vcd file), up to threads of them are
+    # written at the same time
+    def create_vcds(self, vcds):
+        with ThreadPoolExecutor(max_workers=max(min(self._threads, len(vcds)), 1)) as e:
+            for f in [e.submit(self.write_vcd, img_toc, vcd) for img_toc, vcd in vcds]:
+                f.result()
+
         
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -3381,19 +4612,103 @@ if __name__ == "__main__":
     parser.add_argument('--title',
                         help='Title for this iso')
     parser.add_argument('command', nargs=1, 
-                        help='create_pbp|dump_pbp')
+                        help='create_pbp|dump_pbp|update_pbp|verify')
     parser.add_argument('image', nargs='*', help='Image file(s)')
     parser.add_argument('--compression',
                         help='Compression level [0-9]. Default is 1.')
+    parser.add_argument('--eboot',
+                        help='Name of the EBOOT.PBP to create. Default is EBOOT.PBP.')
+    parser.add_argument('--sfo',
+                        help='PARAM.SFO to use with update_pbp.')
+    parser.add_argument('--icon0',
+                        help='ICON0.PNG to use with update_pbp.')
+    parser.add_argument('--icon1',
+                        help='ICON1.PMF to use with update_pbp.')
+    parser.add_argument('--pic0',
+                        help='PIC0.PNG to use with update_pbp.')
+    parser.add_argument('--pic1',
+                        help='PIC1.PNG to use with update_pbp.')
+    parser.add_argument('--snd0',
+                        help='SND0.AT3 to use with update_pbp.')
+    parser.add_argument('--allow-move', action='store_true',
+                        help='Let update_pbp move DATA.PSAR if the new files do not fit in front of it. Never use this for a PS3 EBOOT.PBP.')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of threads to use for compression. Default is 1.')
+    parser.add_argument('--deflate-backend',
+                        help='Deflate implementation to use: zlib, zlib-ng, isal, libdeflate or fastest. Default is zlib.')
+    parser.add_argument('--archive', action='store_true',
+                        help='Try several compression settings for every block and keep the smallest. This is slow.')
+    parser.add_argument('--skip-incompressible', action='store_true',
+                        help='Store blocks that a quick test says will not compress without trying to compress them.')
+    parser.add_argument('--chunk-size', type=int, default=0x9300 * 32,
+                        help='Size in bytes of the reads and writes when encoding a disc. Default is %d.' % (0x9300 * 32))
+    parser.add_argument('--queue-depth', type=int, default=4,
+                        help='Number of chunks to read ahead of and write behind the compression. Default is 4.')
+    parser.add_argument('--check-blocks', action='store_true',
+                        help='Check the SHA1 of every block when dumping an EBOOT.PBP.')
+    parser.add_argument('--dump-psiso-dat', action='store_true',
+                        help='Also write the compressed PSISOIMG of every disc to PSISO<n>.DAT when dumping an EBOOT.PBP.')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Store identical blocks only once.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Write the EBOOT.PBP in one pass without seeking so it can be written to a pipe. Compresses every disc twice.')
+    parser.add_argument('--parallel-discs', action='store_true',
+                        help='Encode all discs of a multi-disc game at the same time.')
+    parser.add_argument('--block-cache',
+                        help='Cache compressed blocks in this file and reuse them in later runs.')
+    parser.add_argument('--block-cache-size', type=int, default=2048,
+                        help='Maximum size of the block cache in MB. Default is 2048.')
     args = parser.parse_args()
 
     p = popstation()
     p.verbose = args.v
+    p.threads = args.threads
+    if args.deflate_backend:
+        p.deflate_backend = get_backend(args.deflate_backend,
+                                        int(args.compression) if args.compression else p.complevel)
+    p.archive = args.archive
+    p.skip_incompressible = args.skip_incompressible
+    p.chunk_size = args.chunk_size
+    p.queue_depth = args.queue_depth
+    p.stream = args.stream
+    p.parallel_discs = args.parallel_discs
+    p.dedup = args.dedup
+    p.check_blocks = args.check_blocks
+    p.dump_psiso_dat = args.dump_psiso_dat
+    if args.block_cache:
+        p.block_cache = blockcache(args.block_cache, args.block_cache_size * 1024 * 1024)
     
+    if args.command[0] == 'verify':
+        reports = []
+        for i in args.image:
+            print('Verify', i, file=sys.stderr) if p.verbose else None
+            reports.append(p.verify_pbp(i))
+        print(json.dumps(reports, indent=2))
+        if not all(r['ok'] for r in reports):
+            sys.exit(1)
+
     if args.command[0] == 'dump_pbp':
         print('Dump EBOOT.PBP')
         p.dump_pbp(args.image[0])
         
+    if args.command[0] == 'update_pbp':
+        if args.sfo and args.title:
+            parser.error('--sfo and --title can not be used together')
+        files = {}
+        for name in ['sfo', 'icon0', 'icon1', 'pic0', 'pic1', 'snd0']:
+            if getattr(args, name):
+                with open(getattr(args, name), 'rb') as f:
+                    files[name] = f.read()
+        for i in args.image:
+            _files = dict(files)
+            if args.title:
+                with PBPReader(i) as pbp:
+                    sfo = pbp.sfo
+                sfo['TITLE']['data'] = args.title
+                _files['sfo'] = GenerateSFO(sfo)
+            print('Update', i) if p.verbose else None
+            p.update_pbp(i, allow_move=args.allow_move, **_files)
+
     if args.command[0] == 'create_pbp':
         for i in args.image:
             p.add_img((i, None))
@@ -3406,6 +4721,8 @@ if __name__ == "__main__":
         if args.compression:
             p.complevel = int(args.compression)
             print('Compression level', p.complevel)
+        if args.eboot:
+            p.eboot = args.eboot
         try:
             p.icon0 = open('ICON0.PNG', 'rb').read()
         except:
@@ -3420,3 +4737,6 @@ if __name__ == "__main__":
             True
     
         p.create_pbp()
+
+    if p.block_cache:
+        p.block_cache.close()
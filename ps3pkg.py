@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Create debug (unsigned) PS3 PKG files without PSL1GHT.
+#
+# This writes the same kind of package as PSL1GHT/tools/ps3py/pkg.py:
+# a 0x80 byte header with magic 0x7F504B47, the header and metadata
+# digests, the metadata block at 0xC0 and the data section at 0x140.
+# The data section holds a 0x20 byte entry for every file and directory,
+# their names and then the file contents, everything aligned to 16 bytes.
+# It is encrypted with the debug PKG keystream: the SHA1 of a 0x40 byte
+# context built from the package digest with a 64 bit block counter in
+# the last 8 bytes, incremented for every 16 bytes.
+#
+# Since the whole layout is known from the file sizes we can work out the
+# digest up front and then stream every file through the encryption in
+# chunks, without a directory walk and without staging the data section.
+#
+# This is a reimplementation and has not been checked byte for byte
+# against pkg.py. The known differences are:
+#  - the files of every directory are listed in sorted order, pkg.py uses
+#    the order glob() returns them in.
+#  - the package digest is the SHA1 of the header and the file table.
+#  - the last 0x20 bytes of the package hold the SHA1 of the rest of the
+#    file, pkg.py leaves them as zero.
+#  - the content type in the metadata is 6, a PS1 classic, by default.
+#    pkg.py has its own hardcoded content type that has not been compared
+#    with this one. Use content_type, or --content-type, to set another one.
+#
+# Because of this pop-fe does not use it yet, its packages are still created
+# with pkg.py until the output has been checked with an independent PKG
+# extractor.
+#
+import argparse
+import hashlib
+import os
+import struct
+
+from crypto_prims import xor
+
+PKG_MAGIC = 0x7F504B47
+# content type for PS1 classics
+CONTENT_TYPE_PSX = 6
+
+
+# offset must be a multiple of 16
+def keystream(digest, offset, length):
+    base = hashlib.sha1(digest[:8] * 2 + digest[8:16] * 2 + bytes(0x18))
+    ks = bytearray()
+    for i in range(int(offset / 16), int((offset + length + 15) / 16)):
+        h = base.copy()
+        h.update(struct.pack('>Q', i))
+        ks += h.digest()[:16]
+    return bytes(ks[:length])
+
+
+def crypt(digest, data, offset):
+    return xor(data, keystream(digest, offset, len(data)))
+
+
+# (name in the package, path) for files below root, directories have None
+# as the path. Every directory lists its files before its subdirectories.
+def pkg_items(root, files):
+    tree = {}
+    for f in files:
+        parts = os.path.relpath(f, root).replace('\\', '/').split('/')
+        d = tree
+        for p in parts[:-1]:
+            d = d.setdefault(p, {})
+        d[parts[-1]] = f
+
+    def walk(d, prefix):
+        for name in sorted(k for k in d if not isinstance(d[k], dict)):
+            yield prefix + name, d[name]
+        for name in sorted(k for k in d if isinstance(d[k], dict)):
+            yield prefix + name, None
+            yield from walk(d[name], prefix + name + '/')
+
+    return list(walk(tree, ''))
+
+
+# items is a list from pkg_items()
+def create_pkg(content_id, items, pkg, content_type=CONTENT_TYPE_PSX, chunk_size=1048576, verbose=False):
+    chunk_size = max(chunk_size & ~0xf, 16)
+    entries = []
+    names = bytearray()
+    for name, path in items:
+        _n = name.encode()
+        entries.append([len(names), len(_n), 0, os.stat(path).st_size if path else 0,
+                        0x80000003 if path else 0x80000004, path])
+        names += _n + bytes(-len(_n) % 16)
+    table_size = 0x20 * len(entries)
+    pos = table_size + len(names)
+    for e in entries:
+        e[0] = e[0] + table_size
+        if e[5]:
+            e[2] = pos
+            pos = pos + ((e[3] + 0xf) & ~0xf)
+    data_size = pos
+
+    table = bytearray()
+    for e in entries:
+        table += struct.pack('>IIQQII', e[0], e[1], e[2], e[3], e[4], 0)
+    table += names
+
+    header = bytearray(0x80)
+    struct.pack_into('>IIIIIIQQQ', header, 0, PKG_MAGIC, 1, 0xC0, 5, 0x80,
+                     len(entries), 0x140 + data_size + 0x60, 0x140, data_size)
+    _c = content_id.encode()[:0x30]
+    header[0x30:0x30 + len(_c)] = _c
+    digest = hashlib.sha1(header + table).digest()[:16]
+    header[0x60:0x70] = digest
+
+    metadata = struct.pack('>IIIIIIIIIIIHHIIIHH',
+                           1, 4, 3,                # drm type: free
+                           2, 4, content_type,
+                           3, 4, 0xE,              # package type
+                           4, 8, 0, 0, data_size,
+                           5, 4, 0x1061, 0)        # packaged by
+
+    def signature(buf):
+        _h = hashlib.sha1(buf).digest()[3:19]
+        return _h + crypt(_h, bytes(0x30), 0)
+
+    pkg_sha1 = hashlib.sha1()
+    with open(pkg, 'wb') as o:
+        def write(buf):
+            pkg_sha1.update(buf)
+            o.write(buf)
+
+        write(header)
+        write(signature(header))
+        write(metadata)
+        write(signature(metadata))
+        write(crypt(digest, table, 0))
+        for e in entries:
+            if not e[5]:
+                continue
+            print('Adding', e[5], 'to', pkg) if verbose else None
+            offset = e[2]
+            with open(e[5], 'rb') as f:
+                left = e[3]
+                while left:
+                    buf = f.read(min(chunk_size, left))
+                    if not buf:
+                        raise Exception('%s changed while we were reading it' % e[5])
+                    left = left - len(buf)
+                    if not left:
+                        buf = buf + bytes(-(e[3]) % 16)
+                    write(crypt(digest, buf, offset))
+                    offset = offset + len(buf)
+        write(bytes(0x40))
+        o.write(pkg_sha1.digest() + bytes(0xc))
+
+
+def walk_dir(root):
+    files = []
+    for d, dirs, names in os.walk(root):
+        for n in names:
+            files.append(os.path.join(d, n))
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--contentid', required=True,
+                        help='Content ID of the package')
+    parser.add_argument('-v', action='store_true', help='Verbose')
+    parser.add_argument('--content-type', type=int, default=CONTENT_TYPE_PSX,
+                        help='Content type in the metadata. Default is %d, PS1 classic.' % CONTENT_TYPE_PSX)
+    parser.add_argument('dir', nargs=1, help='Directory to package')
+    parser.add_argument('pkg', nargs=1, help='Name of the PKG file to create')
+    args = parser.parse_args()
+
+    create_pkg(args.contentid, pkg_items(args.dir[0], walk_dir(args.dir[0])),
+               args.pkg[0], content_type=args.content_type, verbose=args.v)
@@ -8,8 +8,23 @@ from random import SystemRandom
 
 randrange = SystemRandom().randrange
 
-def calc_sign(data):
-        """Function to compute the ISO.BIN.DAT signature"""
+def sha1_file(f, chunk_size=1048576):
+        """SHA1 of a file, read in chunks so it takes constant memory"""
+        h = hashlib.sha1()
+        with open(f, 'rb') as _f:
+                while True:
+                        _b = _f.read(chunk_size)
+                        if not _b:
+                                break
+                        h.update(_b)
+        return h
+
+def calc_sign(data=None, digest=None):
+        """Function to compute the ISO.BIN.DAT signature
+
+        data is either the ISO.BIN.DAT itself or a hashlib.sha1() object
+        that has already been fed the ISO.BIN.DAT, and digest is its SHA1
+        if it has already been computed."""
         
         curves = [{'p': 1461501637330902918203684832716283019655932542975,
                    'a': 1461501637330902918203684832716283019655932542975,
@@ -37,6 +52,10 @@ def calc_sign(data):
 	        return result
 
         def calculate_sha1_hash(data):
+	        if digest is not None:
+		        return digest
+	        if hasattr(data, 'digest'):
+		        return data.digest()
 	        return hashlib.sha1(data).digest()
         
         k = 0x00bf21224b041f29549db25e9aade19e720a1fe0f1
@@ -54,8 +73,7 @@ def calc_sign(data):
         return rr + ss
 
 if __name__ == "__main__":
-    with open(sys.argv[1], 'rb') as _f:
-        _b = calc_sign(_f.read())
+    _b = calc_sign(sha1_file(sys.argv[1]))
     with open(sys.argv[1], 'ab') as _f:
         _f.seek(0, 2)
         _f.write(_b)
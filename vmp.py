@@ -10,10 +10,8 @@ import argparse
 import hashlib
 import os
 import struct
-try:
-    from Crypto.Cipher import AES
-except:
-    print('Crypto is not installed.\nYou should install Crypto by running:\npip3 install Crypto')
+
+from crypto_prims import ecb, xor, xor_byte
 
 
 def dump_vmp(f):
@@ -49,7 +47,7 @@ def encode_vmp(input_data):
         
     workbuf = bytearray(0x14)
     workbuf[:0x10] = salt_seed[:0x10]
-    obj = AES.new(key, AES.MODE_ECB)
+    obj = ecb(key)
     workbuf = bytearray(obj.decrypt(bytes(workbuf[:0x10])))
 
     salt = bytearray(0x40)
@@ -58,17 +56,14 @@ def encode_vmp(input_data):
     workbuf[:0x10] = salt_seed[:0x10]
     workbuf = obj.encrypt(bytes(workbuf[:0x10]))
     salt[0x10:0x20] = workbuf[:0x10]
-    for i in range(0x10):
-        salt[i] = salt[i] ^ iv[i]
+    salt[:0x10] = xor(salt[:0x10], iv)
 
     workbuf = bytearray(b'\xff' * 0x14)
     workbuf[:4] = salt_seed[0x10:0x14]
-    for i in range(0x10):
-        salt[0x10 + i] = salt[0x10 + i] ^ workbuf[i]
+    salt[0x10:0x20] = xor(salt[0x10:0x20], workbuf)
 
     salt[0x14:0x20] = bytes(12)
-    for i in range(0x40):
-        salt[i] = salt[i] ^ 0x36
+    salt[:] = xor_byte(salt, 0x36)
 
     h = hashlib.sha1()
     h.update(salt)
@@ -77,8 +72,7 @@ def encode_vmp(input_data):
     workbuf = h.digest()
 
     h = hashlib.sha1()
-    for i in range(0x40):
-        salt[i] = salt[i] ^ 0x6a
+    salt[:] = xor_byte(salt, 0x6a)
     h.update(salt)
     h.update(workbuf)
     workbuf = h.digest()